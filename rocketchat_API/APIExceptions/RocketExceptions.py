@@ -13,3 +13,15 @@ class RocketAuthenticationException(Exception):
 
 class RocketMissingParamException(Exception):
     pass
+
+
+class RocketDeadlineException(Exception):
+    pass
+
+
+class RocketSpoolFullException(Exception):
+    pass
+
+
+class RocketClientClosedException(Exception):
+    pass
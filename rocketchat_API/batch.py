@@ -0,0 +1,206 @@
+# -*-coding:utf-8-*-
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from rocketchat_API.APIExceptions.RocketExceptions import RocketMissingParamException
+
+
+class Ref:
+    """Lazy path into the JSON body of a batched call's result, e.g. created['channel']['_id'].
+
+    Passed as an argument of a later call it makes that call wait for the first one."""
+
+    def __init__(self, future, path):
+        self.future = future
+        self.path = path
+
+    def __getitem__(self, key):
+        return Ref(self.future, self.path + (key,))
+
+    def resolve(self):
+        body = self.future.result()
+        if callable(getattr(body, 'json', None)):
+            body = body.json()
+        try:
+            for key in self.path:
+                body = body[key]
+        except (KeyError, IndexError, TypeError):
+            raise RocketMissingParamException('{} missing from the result of {}'.format(
+                ''.join('[{!r}]'.format(key) for key in self.path), self.future.method))
+        return body
+
+
+class _Referable:
+    method = None
+
+    def __getitem__(self, key):
+        return Ref(self, (key,))
+
+
+class BatchFuture(_Referable, Future):
+    """Future of a call queued in a Batch, indexing it gives a Ref into its result."""
+
+
+class AsyncBatchFuture(_Referable, asyncio.Future):
+    """Future of a call queued in an AsyncBatch, indexing it gives a Ref into its result."""
+
+
+def dependencies(value):
+    """Batch futures referenced by value, directly, through a Ref or inside lists, tuples and dicts."""
+    if isinstance(value, Ref):
+        return {value.future}
+    if isinstance(value, _Referable):
+        return {value}
+    found = set()
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (list, tuple, set, type({}.values()))):
+        for item in value:
+            found |= dependencies(item)
+    return found
+
+
+def resolve(value):
+    """value with every future and Ref replaced by what it stands for."""
+    if isinstance(value, Ref):
+        return value.resolve()
+    if isinstance(value, _Referable):
+        return value.result()
+    if isinstance(value, dict):
+        return {key: resolve(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(resolve(item) for item in value)
+    return value
+
+
+def _failed(futures):
+    for future in futures:
+        if future.cancelled() or future.exception() is not None:
+            return future
+    return None
+
+
+class _Queue:
+    # Type of the futures returned for queued calls
+    future_class = None
+
+    def __init__(self, rocket):
+        self.rocket = rocket
+        self._calls = []
+        self._futures = set()
+
+    def __getattr__(self, name):
+        method = getattr(self.rocket, name)
+        if not callable(method) or name.startswith('_'):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            for dependency in dependencies((args, kwargs)):
+                if not dependency.done() and dependency not in self._futures:
+                    raise ValueError('{} depends on a call of another batch'.format(name))
+            future = self.future_class()
+            future.method = name
+            self._calls.append((future, name, args, kwargs))
+            self._futures.add(future)
+            return future
+
+        queue.__name__ = name
+        queue.__doc__ = method.__doc__
+        return queue
+
+    def _cancel(self):
+        for future, _, _, _ in self._calls:
+            future.cancel()
+
+
+class Batch(_Queue):
+    """Queues calls of the sync client and runs them when the with block ends.
+
+    Inside the block client methods return a BatchFuture instead of running. Futures and Refs
+    (future['channel']['_id']) can be passed as arguments of later calls, which then wait for the
+    calls they refer to; everything else runs right away on the client's thread pool, as many at
+    a time as max_workers allows. A call whose dependency failed fails with the same exception and
+    is cancelled if the dependency was. The block is left once every call is done; if it raises,
+    nothing runs."""
+
+    future_class = BatchFuture
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._cancel()
+            return
+        self.run()
+
+    def __start(self, future, name, args, kwargs, running):
+        failed = _failed(dependencies((args, kwargs)))
+        if failed is not None and failed.cancelled():
+            future.cancel()
+        elif failed is not None:
+            future.set_exception(failed.exception())
+        else:
+            try:
+                running[self.rocket.submit(name, *resolve(args), **resolve(kwargs))] = future
+            except Exception as e:
+                future.set_exception(e)
+
+    def run(self):
+        # Calls only depend on earlier ones, so the first waiting call always has a running dependency
+        pending = list(self._calls)
+        running = {}
+        while pending or running:
+            waiting = []
+            for future, name, args, kwargs in pending:
+                if all(dependency.done() for dependency in dependencies((args, kwargs))):
+                    self.__start(future, name, args, kwargs, running)
+                else:
+                    waiting.append((future, name, args, kwargs))
+            pending = waiting
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for call_future in done:
+                    future = running.pop(call_future)
+                    if call_future.exception() is not None:
+                        future.set_exception(call_future.exception())
+                    else:
+                        future.set_result(call_future.result())
+
+
+class AsyncBatch(_Queue):
+    """Queues calls of the async client and runs them when the async with block ends.
+
+    Works like Batch: calls return an AsyncBatchFuture, futures and Refs passed as arguments make a
+    call wait for the ones it refers to and the rest run concurrently within the client's limits."""
+
+    future_class = AsyncBatchFuture
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._cancel()
+            return
+        await self.run()
+
+    async def __run_call(self, future, name, args, kwargs):
+        needed = dependencies((args, kwargs))
+        if needed:
+            await asyncio.wait(needed)
+        failed = _failed(needed)
+        if failed is not None and failed.cancelled():
+            future.cancel()
+            return
+        try:
+            if failed is not None:
+                raise failed.exception()
+            result = await getattr(self.rocket, name)(*resolve(args), **resolve(kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    async def run(self):
+        await asyncio.gather(*[self.__run_call(*call) for call in self._calls])
@@ -0,0 +1,114 @@
+# -*-coding:utf-8-*-
+import asyncio
+import json
+
+TEXT = 'text'
+ATTACHMENTS = 'attachments'
+
+
+class MessageCoalescer:
+    """Merges bursts of chat_post_message calls of the async client into fewer posts.
+
+    Messages are buffered per room (and per set of extra options such as alias or emoji) until
+    window seconds have passed since the first one or max_messages are waiting, then posted as one
+    message: in TEXT mode the texts are joined with separator, in ATTACHMENTS mode every message
+    becomes an attachment. Attachments passed with a message are kept in both modes. In TEXT mode
+    a message that would take the joined text over max_length characters (the server's default
+    Message_MaxAllowedSize) is held for the next post instead. post_message returns a future
+    resolving to the result of the combined post."""
+
+    def __init__(self, rocket, window=2.0, max_messages=50, mode=TEXT, separator='\n', max_length=5000):
+        if mode not in (TEXT, ATTACHMENTS):
+            raise ValueError('mode must be {} or {}'.format(TEXT, ATTACHMENTS))
+        self.rocket = rocket
+        self.window = window
+        self.max_messages = max_messages
+        self.mode = mode
+        self.separator = separator
+        self.max_length = max_length
+        self.messages = 0
+        self.posts = 0
+        self._buckets = {}
+        self._timers = {}
+        self._flushes = set()
+
+    def post_message(self, text, room_id=None, channel=None, **kwargs):
+        """Buffers a message and returns a future for the post it ends up in."""
+        attachments = kwargs.pop('attachments', None) or []
+        key = (room_id, channel, json.dumps(kwargs, sort_keys=True))
+        future = asyncio.get_event_loop().create_future()
+        bucket = self._buckets.setdefault(key, [])
+        if self.mode == TEXT and bucket and len(self.__join(bucket + [(text, None, None)])) > self.max_length:
+            self.__schedule_flush(key)
+            bucket = self._buckets.setdefault(key, [])
+        bucket.append((text, attachments, future))
+        self.messages += 1
+        if len(bucket) >= self.max_messages:
+            self.__schedule_flush(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_event_loop().call_later(self.window, self.__schedule_flush, key)
+        return future
+
+    def __schedule_flush(self, key):
+        # The bucket is taken right away so messages arriving before the post starts open a new one
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        bucket = self._buckets.pop(key, None)
+        if not bucket:
+            return
+        task = asyncio.ensure_future(self.__flush(key, bucket))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    def __join(self, bucket):
+        return self.separator.join(text for text, _, _ in bucket if text)
+
+    def __merge(self, bucket):
+        attachments = []
+        if self.mode == TEXT:
+            text = self.__join(bucket)
+            for _, message_attachments, _ in bucket:
+                attachments.extend(message_attachments)
+        else:
+            text = ''
+            for message_text, message_attachments, _ in bucket:
+                if message_text:
+                    attachments.append({'text': message_text})
+                attachments.extend(message_attachments)
+        return text, attachments
+
+    async def __flush(self, key, bucket):
+        room_id, channel, options = key
+        kwargs = json.loads(options)
+        if len(bucket) == 1:
+            text, attachments = bucket[0][0], bucket[0][1]
+        else:
+            text, attachments = self.__merge(bucket)
+        if attachments:
+            kwargs['attachments'] = attachments
+        try:
+            result = await self.rocket.chat_post_message(text, room_id=room_id, channel=channel, **kwargs)
+        except Exception as e:
+            for _, _, future in bucket:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, _, future in bucket:
+                if not future.done():
+                    future.set_result(result)
+        self.posts += 1
+
+    async def flush(self):
+        """Posts everything buffered right away."""
+        for key in list(self._buckets):
+            self.__schedule_flush(key)
+        if self._flushes:
+            await asyncio.wait(list(self._flushes))
+
+    def metrics(self):
+        return {
+            'messages': self.messages,
+            'posts': self.posts,
+            'buffered': sum(len(bucket) for bucket in self._buckets.values()),
+        }
@@ -0,0 +1,79 @@
+# -*-coding:utf-8-*-
+import asyncio
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+
+FanOutResult = namedtuple('FanOutResult', ['index', 'arg_set', 'result', 'exception'])
+FanOutResult.__doc__ = """Outcome of one item of a fan-out call.
+
+index is the position of the item in the input, arg_set the arguments it was called with.
+Exactly one of result and exception is set."""
+
+
+def expand_arg_set(arg_set):
+    """Turns a fan-out argument set into (args, kwargs).
+
+    A dict is used as keyword arguments, a tuple or list as positional arguments and anything
+    else as the single positional argument."""
+    if isinstance(arg_set, dict):
+        return (), arg_set
+    if isinstance(arg_set, (tuple, list)):
+        return tuple(arg_set), {}
+    return (arg_set,), {}
+
+
+def _result_of(index, arg_set, future):
+    exception = future.exception()
+    if exception is not None:
+        return FanOutResult(index, arg_set, None, exception)
+    return FanOutResult(index, arg_set, future.result(), None)
+
+
+def iterate_futures(submit, arg_sets, ordered=True, limit=10):
+    """Calls submit(args, kwargs) for every argument set and yields a FanOutResult per returned
+    concurrent Future, in input order or as they complete when ordered is False.
+
+    arg_sets is consumed lazily so that at most limit futures are pending at a time."""
+    if ordered:
+        pending = deque()
+        for index, arg_set in enumerate(arg_sets):
+            pending.append((index, arg_set, submit(*expand_arg_set(arg_set))))
+            while len(pending) >= limit:
+                yield _result_of(*pending.popleft())
+        while pending:
+            yield _result_of(*pending.popleft())
+    else:
+        pending = {}
+        for index, arg_set in enumerate(arg_sets):
+            pending[submit(*expand_arg_set(arg_set))] = (index, arg_set)
+            while len(pending) >= limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _result_of(*(pending.pop(future) + (future,)))
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield _result_of(*(pending.pop(future) + (future,)))
+
+
+def paced(arg_sets, rate):
+    """Yields arg_sets at most rate items a second, to feed map with a rate limit."""
+    next_at = time.monotonic()
+    for arg_set in arg_sets:
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_at = time.monotonic() + 1.0 / rate
+        yield arg_set
+
+
+async def apaced(arg_sets, rate):
+    """Same as paced as an async iterable, to feed amap."""
+    next_at = time.monotonic()
+    for arg_set in arg_sets:
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        next_at = time.monotonic() + 1.0 / rate
+        yield arg_set
@@ -0,0 +1,63 @@
+# -*-coding:utf-8-*-
+from collections import deque
+
+IDEMPOTENT_READS = ('channels.info', 'groups.info', 'rooms.info', 'users.info')
+
+
+class HedgePolicy:
+    """Decides when the async client sends a second copy of a slow idempotent GET.
+
+    If delay is None the hedge fires once a request has been outstanding longer than the given
+    percentile of the endpoint's recently observed latencies (and never before min_samples have been
+    seen). budget caps hedges to that fraction of hedgeable traffic: every request earns budget
+    tokens, each hedge spends one, and at most max_tokens can be saved up for a burst."""
+
+    def __init__(self, endpoints=IDEMPOTENT_READS, delay=None, percentile=95, budget=0.1,
+                 window=500, min_samples=20, max_tokens=10):
+        self.endpoints = frozenset(endpoints)
+        self.delay = delay
+        self.percentile = percentile
+        self.budget = budget
+        self.window = window
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._tokens = 0.0
+        self._latencies = {}
+
+    def applies_to(self, endpoint):
+        return endpoint in self.endpoints
+
+    def record(self, endpoint, latency):
+        """Feeds the latency of a completed request."""
+        self._latencies.setdefault(endpoint, deque(maxlen=self.window)).append(latency)
+
+    def hedge_delay(self, endpoint):
+        """Seconds to wait before hedging a request to endpoint, None to not hedge it."""
+        self.requests += 1
+        self._tokens = min(self.max_tokens, self._tokens + self.budget)
+        if self.delay is not None:
+            return self.delay
+        latencies = self._latencies.get(endpoint)
+        if not latencies or len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))]
+
+    def try_hedge(self):
+        """Spends a budget token for a hedge, returns False when the budget is exhausted."""
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        self.hedges += 1
+        return True
+
+    def metrics(self):
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'hedge_rate': float(self.hedges) / self.requests if self.requests else 0.0,
+        }
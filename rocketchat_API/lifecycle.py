@@ -0,0 +1,56 @@
+# -*-coding:utf-8-*-
+import datetime
+from collections import namedtuple
+
+ARCHIVE = 'archive'
+UNARCHIVE = 'unarchive'
+DELETE = 'delete'
+SET_TYPE = 'set_type'
+
+# Client method per action and room type: c is a public channel, p a private group
+METHODS = {
+    ARCHIVE: {'c': 'channels_archive', 'p': 'groups_archive'},
+    UNARCHIVE: {'c': 'channels_unarchive', 'p': 'groups_unarchive'},
+    DELETE: {'c': 'channels_delete', 'p': 'groups_delete'},
+    SET_TYPE: {'c': 'channels_set_type', 'p': 'groups_set_type'},
+}
+
+RoomOutcome = namedtuple('RoomOutcome', ['room_id', 'room_type', 'action', 'success', 'result', 'error'])
+RoomOutcome.__doc__ = """Outcome of a lifecycle action on one room.
+
+result is what the client method returned, error the exception raised if any."""
+
+
+def room_key(room):
+    """(room_id, room_type) of a room dict as returned by rooms_get or of such a tuple."""
+    if isinstance(room, dict):
+        return room['_id'], room.get('t')
+    return tuple(room)
+
+
+def method_for(action, room_type):
+    try:
+        return METHODS[action][room_type]
+    except KeyError:
+        raise ValueError('no {} endpoint for room type {}'.format(action, room_type))
+
+
+def parse_date(value):
+    """Parses a date of the REST API, either ISO 8601 or {'$date': milliseconds}, as aware UTC datetime."""
+    if isinstance(value, dict):
+        return datetime.datetime.fromtimestamp(value['$date'] / 1000.0, datetime.timezone.utc)
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc)
+
+
+def last_activity(room):
+    """Last message date of a room, falling back to its last update or creation."""
+    for field in ('lm', '_updatedAt', 'ts'):
+        if room.get(field):
+            return parse_date(room[field])
+    return None
+
+
+def is_stale(room, older_than):
+    """True for channels and groups without activity since older_than (an aware datetime)."""
+    activity = last_activity(room)
+    return room.get('t') in ('c', 'p') and activity is not None and activity < older_than
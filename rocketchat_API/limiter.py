@@ -0,0 +1,134 @@
+# -*-coding:utf-8-*-
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+class _AIMDLimit:
+    """Additive-increase/multiplicative-decrease concurrency window.
+
+    The window grows by one request per window's worth of successful calls while the short-term
+    latency average stays within tolerance times the long-term baseline average, and is multiplied
+    by backoff on rising latency, 429s, 5xx responses and failed requests (status None)."""
+
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=200, backoff=0.5, tolerance=2.0,
+                 smoothing=0.2, baseline_smoothing=0.02):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.baseline_smoothing = baseline_smoothing
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.smoothed_latency = None
+        self.decreases = 0
+        self._limit = float(initial_limit)
+        self._last_decrease = 0
+
+    @property
+    def limit(self):
+        """Current number of requests allowed in flight."""
+        return max(self.min_limit, int(self._limit))
+
+    @staticmethod
+    def is_overload(status):
+        return status is None or status == 429 or status >= 500
+
+    def _update(self, latency, status):
+        now = time.monotonic()
+        if self.smoothed_latency is None:
+            self.smoothed_latency = latency
+        else:
+            self.smoothed_latency += (latency - self.smoothed_latency) * self.smoothing
+        congested = (self.baseline_latency is not None and
+                     self.smoothed_latency > self.baseline_latency * self.tolerance)
+        if self.is_overload(status) or congested:
+            # Requests that started before the last cut already saw the old window, don't cut again for them
+            if now - latency >= self._last_decrease:
+                self._limit = max(self.min_limit, self._limit * self.backoff)
+                self._last_decrease = now
+                self.decreases += 1
+        else:
+            self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+        if status is not None and not self.is_overload(status):
+            if self.baseline_latency is None:
+                self.baseline_latency = latency
+            else:
+                self.baseline_latency += (latency - self.baseline_latency) * self.baseline_smoothing
+
+    def metrics(self):
+        """Current limit, in-flight count and latency baseline."""
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'baseline_latency': self.baseline_latency,
+            'smoothed_latency': self.smoothed_latency,
+            'decreases': self.decreases,
+        }
+
+
+class AdaptiveLimiter(_AIMDLimit):
+    """Thread-safe adaptive concurrency limiter for the synchronous client."""
+
+    def __init__(self, *args, **kwargs):
+        super(AdaptiveLimiter, self).__init__(*args, **kwargs)
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, status):
+        """Gives back a slot, feeding the request latency and HTTP status (None on failure)."""
+        with self._condition:
+            self.in_flight -= 1
+            self._update(latency, status)
+            self._condition.notify_all()
+
+    def abandon(self):
+        """Gives back a slot that wasn't used for a request, e.g. when its deadline ran out meanwhile."""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+class AsyncAdaptiveLimiter(_AIMDLimit):
+    """Adaptive concurrency limiter for the asyncio client."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncAdaptiveLimiter, self).__init__(*args, **kwargs)
+        self._waiters = deque()
+
+    async def acquire(self):
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self, latency, status):
+        """Gives back a slot, feeding the request latency and HTTP status (None on failure).
+
+        This is a plain method so it can run from a finally block of a cancelled task."""
+        self.in_flight -= 1
+        self._update(latency, status)
+        self.__wake()
+
+    def abandon(self):
+        """Gives back a slot that wasn't used for a request, e.g. when its deadline ran out meanwhile."""
+        self.in_flight -= 1
+        self.__wake()
+
+    def __wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
@@ -0,0 +1,224 @@
+# -*-coding:utf-8-*-
+"""Scenario-driven load generator on top of rocketchat_async.
+
+Against the test server (docker-compose-test-server.yml):
+
+    python -m rocketchat_API.loadgen --register --users 20 --duration 60
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+
+from rocketchat_API import rocketchat_async
+
+LOGIN = 'login'
+JOIN = 'join'
+POST = 'post'
+HISTORY = 'history'
+UPLOAD = 'upload'
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of a sorted list."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+
+class Scenario:
+    """What every simulated user does once logged in and joined to the rooms.
+
+    weights sets the mix of POST, HISTORY and UPLOAD actions. Between two actions a user thinks for
+    an exponentially distributed time with mean think_time seconds, so each user runs about
+    1 / think_time actions per second. Every action picks one of rooms (ids of public channels)."""
+
+    def __init__(self, rooms=('GENERAL',), weights=None, think_time=2.0, message_size=100, history_count=50,
+                 upload_file=None):
+        if weights is None:
+            weights = {POST: 5, HISTORY: 3, UPLOAD: 1} if upload_file else {POST: 5, HISTORY: 3}
+        unknown = set(weights) - {POST, HISTORY, UPLOAD}
+        if unknown:
+            raise ValueError('unknown actions {}'.format(', '.join(sorted(unknown))))
+        if weights.get(UPLOAD) and upload_file is None:
+            raise ValueError('upload_file is required for {} actions'.format(UPLOAD))
+        self.rooms = tuple(rooms)
+        self.weights = weights
+        self.think_time = think_time
+        self.message_size = message_size
+        self.history_count = history_count
+        self.upload_file = upload_file
+
+    def next_action(self, rng):
+        return rng.choices(list(self.weights), weights=list(self.weights.values()))[0]
+
+    def think(self, rng):
+        return rng.expovariate(1.0 / self.think_time) if self.think_time > 0 else 0
+
+    def message(self, rng):
+        return ''.join(rng.choice(string.ascii_letters + ' ') for _ in range(self.message_size))
+
+
+class LoadReport:
+    """Latencies and errors per action of a load run."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.started = time.monotonic()
+        self.finished = None
+
+    def record(self, action, latency, ok):
+        self.latencies.setdefault(action, []).append(latency)
+        if not ok:
+            self.errors[action] = self.errors.get(action, 0) + 1
+
+    def summary(self):
+        """Per action: calls, errors, achieved calls per second and latency percentiles in seconds."""
+        elapsed = (self.finished or time.monotonic()) - self.started
+        actions = {}
+        for action, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            actions[action] = {
+                'count': len(ordered),
+                'errors': self.errors.get(action, 0),
+                'throughput': len(ordered) / elapsed if elapsed else 0.0,
+                'p50': percentile(ordered, 50),
+                'p90': percentile(ordered, 90),
+                'p95': percentile(ordered, 95),
+                'p99': percentile(ordered, 99),
+                'max': ordered[-1],
+            }
+        return actions
+
+    def format(self):
+        lines = ['{:<8} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            'action', 'count', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for action, stats in sorted(self.summary().items()):
+            lines.append('{:<8} {:>7} {:>7} {:>8.2f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                action, stats['count'], stats['errors'], stats['throughput'],
+                *[stats[key] * 1000 for key in ('p50', 'p90', 'p95', 'p99', 'max')]))
+        return '\n'.join(lines)
+
+
+class LoadGenerator:
+    """Simulates users running a Scenario against a server, each through its own rocketchat_async client.
+
+    users are (username, password) pairs. Every user logs in, joins the scenario's rooms and then runs
+    actions until duration seconds have passed; users start spread evenly over ramp_up seconds.
+    client_kwargs go to rocketchat_async.RocketChat. run() returns a LoadReport."""
+
+    def __init__(self, server_url, users, scenario, duration=60.0, ramp_up=0.0, seed=None, client_kwargs=None):
+        self.server_url = server_url
+        self.users = list(users)
+        self.scenario = scenario
+        self.duration = duration
+        self.ramp_up = ramp_up
+        self.seed = seed
+        self.client_kwargs = client_kwargs or {}
+
+    @staticmethod
+    async def __timed(report, action, call):
+        start = time.monotonic()
+        try:
+            with rocketchat_async.decoded_responses():
+                result = await call
+        except Exception:
+            report.record(action, time.monotonic() - start, False)
+            return None
+        report.record(action, time.monotonic() - start, bool(result.get('success')))
+        return result
+
+    async def __act(self, rocket, action, rng, report):
+        room_id = rng.choice(self.scenario.rooms)
+        if action == POST:
+            call = rocket.chat_post_message(self.scenario.message(rng), room_id=room_id)
+        elif action == HISTORY:
+            call = rocket.channels_history(room_id, count=self.scenario.history_count)
+        else:
+            call = rocket.rooms_upload(room_id, self.scenario.upload_file)
+        await self.__timed(report, action, call)
+
+    async def __user(self, index, username, password, report, ends_at):
+        rng = random.Random(None if self.seed is None else self.seed + index)
+        await asyncio.sleep(self.ramp_up * index / max(1, len(self.users)))
+        rocket = rocketchat_async.RocketChat(server_url=self.server_url, **self.client_kwargs)
+        try:
+            # login is blocking, it runs on the default executor so users log in concurrently
+            start = time.monotonic()
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, rocket.login, username, password)
+            except Exception:
+                report.record(LOGIN, time.monotonic() - start, False)
+                return
+            report.record(LOGIN, time.monotonic() - start, True)
+            for room_id in self.scenario.rooms:
+                await self.__timed(report, JOIN, rocket.channels_join(room_id))
+            while time.monotonic() < ends_at:
+                await self.__act(rocket, self.scenario.next_action(rng), rng, report)
+                await asyncio.sleep(min(self.scenario.think(rng), max(0, ends_at - time.monotonic())))
+        finally:
+            await rocket.close()
+
+    async def run(self):
+        report = LoadReport()
+        ends_at = report.started + self.ramp_up + self.duration
+        await asyncio.gather(*[self.__user(index, username, password, report, ends_at)
+                               for index, (username, password) in enumerate(self.users)])
+        report.finished = time.monotonic()
+        return report
+
+
+async def register_users(server_url, count, prefix='loadtest', password='loadtest', client_kwargs=None):
+    """Registers count users named prefix-0, prefix-1, ... and returns their (username, password) pairs.
+
+    Users that already exist are kept as they are."""
+    rocket = rocketchat_async.RocketChat(server_url=server_url, **(client_kwargs or {}))
+    users = ['{}-{}'.format(prefix, index) for index in range(count)]
+    try:
+        await asyncio.gather(*[rocket.users_register(email='{}@example.com'.format(username), name=username,
+                                                     password=password, username=username)
+                               for username in users])
+    finally:
+        await rocket.close()
+    return [(username, password) for username in users]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m rocketchat_API.loadgen',
+                                     description='Simulates Rocket.Chat users and reports throughput and latency.')
+    parser.add_argument('--server-url', default='http://127.0.0.1:3000')
+    parser.add_argument('--users', type=int, default=10, help='simulated users')
+    parser.add_argument('--user-prefix', default='loadtest', help='users are named <prefix>-<n>')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--register', action='store_true', help='register the users first')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds of load after ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='seconds over which users start')
+    parser.add_argument('--think-time', type=float, default=2.0, help='mean seconds between actions of a user')
+    parser.add_argument('--rooms', default='GENERAL', help='comma separated channel ids')
+    parser.add_argument('--weights', help='action mix, e.g. post=5,history=3,upload=1')
+    parser.add_argument('--message-size', type=int, default=100)
+    parser.add_argument('--upload-file', help='file sent by upload actions')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    weights = None
+    if args.weights:
+        weights = {action: float(weight) for action, weight in
+                   (item.split('=') for item in args.weights.split(','))}
+    scenario = Scenario(rooms=args.rooms.split(','), weights=weights, think_time=args.think_time,
+                        message_size=args.message_size, upload_file=args.upload_file)
+
+    async def run():
+        if args.register:
+            users = await register_users(args.server_url, args.users, args.user_prefix, args.password)
+        else:
+            users = [('{}-{}'.format(args.user_prefix, index), args.password) for index in range(args.users)]
+        generator = LoadGenerator(args.server_url, users, scenario, duration=args.duration,
+                                  ramp_up=args.ramp_up, seed=args.seed)
+        return await generator.run()
+
+    print(asyncio.run(run()).format())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# -*-coding:utf-8-*-
+
+
+class PermissionIndex:
+    """Local permission index filled by permissions_index of either client.
+
+    Keeps permission -> roles and role -> permissions, so can() is a set lookup. cursor is the
+    newest _updatedAt seen, the next refresh only fetches permissions changed after it."""
+
+    def __init__(self):
+        self.cursor = None
+        self._roles = {}
+        self._permissions = {}
+
+    def __len__(self):
+        return len(self._roles)
+
+    def __contains__(self, permission):
+        return permission in self._roles
+
+    def can(self, role, permission):
+        """True if role has permission."""
+        return permission in self._permissions.get(role, ())
+
+    def roles(self, permission):
+        return frozenset(self._roles.get(permission, ()))
+
+    def permissions(self, role):
+        return frozenset(self._permissions.get(role, ()))
+
+    def __remove(self, permission):
+        for role in self._roles.pop(permission, ()):
+            self._permissions[role].discard(permission)
+            if not self._permissions[role]:
+                del self._permissions[role]
+
+    def set(self, permission, roles):
+        self.__remove(permission)
+        self._roles[permission] = set(roles)
+        for role in roles:
+            self._permissions.setdefault(role, set()).add(permission)
+
+    def __advance(self, entry):
+        updated_at = entry.get('_updatedAt')
+        if isinstance(updated_at, str) and (self.cursor is None or updated_at > self.cursor):
+            self.cursor = updated_at
+
+    def apply(self, payload):
+        """Applies a permissions.listAll answer ({'update': [...], 'remove': [...]})."""
+        for permission in payload.get('update', []):
+            self.set(permission['_id'], permission.get('roles', []))
+            self.__advance(permission)
+        for permission in payload.get('remove', []):
+            self.__remove(permission['_id'])
+            self.__advance(permission)
@@ -0,0 +1,59 @@
+# -*-coding:utf-8-*-
+import datetime
+
+OFFLINE = 'offline'
+
+
+class PresenceTable:
+    """Local presence table filled by users_presence_snapshot of either client.
+
+    Lookups by user id or username are dictionary hits. user_ids limits the table to those users,
+    otherwise everybody the server reports is tracked. Users the server doesn't list as online
+    after a full snapshot are offline."""
+
+    # Overlap between consecutive delta polls, so changes close to the cursor aren't lost to clock skew
+    CURSOR_OVERLAP = datetime.timedelta(seconds=5)
+
+    def __init__(self, user_ids=None):
+        self.user_ids = frozenset(user_ids) if user_ids is not None else None
+        self.cursor = None
+        self.bulk_supported = None
+        self._statuses = {}
+        self._usernames = {}
+
+    def __len__(self):
+        return len(self._statuses)
+
+    def tracks(self, user_id):
+        return self.user_ids is None or user_id in self.user_ids
+
+    def status(self, user_id=None, username=None):
+        """Status of a user (online, away, busy or offline)."""
+        if user_id is None:
+            user_id = self._usernames.get(username)
+        return self._statuses.get(user_id, OFFLINE)
+
+    def online(self):
+        """Ids of the users that aren't offline."""
+        return {user_id for user_id, status in self._statuses.items() if status != OFFLINE}
+
+    def next_cursor(self):
+        """Value for the from parameter of the next users.presence poll."""
+        moment = datetime.datetime.now(datetime.timezone.utc) - self.CURSOR_OVERLAP
+        return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def set(self, user_id, status, username=None):
+        if not self.tracks(user_id):
+            return
+        self._statuses[user_id] = status
+        if username:
+            self._usernames[username] = user_id
+
+    def apply(self, payload, cursor):
+        """Applies a users.presence answer fetched with the cursor taken just before the call."""
+        if payload.get('full'):
+            # A full answer only lists users that are not offline
+            self._statuses = dict.fromkeys(self._statuses, OFFLINE)
+        for user in payload.get('users', []):
+            self.set(user.get('_id'), user.get('status', OFFLINE), user.get('username'))
+        self.cursor = cursor
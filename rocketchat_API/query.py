@@ -0,0 +1,50 @@
+# -*-coding:utf-8-*-
+import json
+
+
+class Query:
+    """Builds the fields, query and sort parameters understood by list endpoints such as users_list,
+    channels_list, groups_list_all and channels_members.
+
+    Every method returns a new Query, so presets can be shared and extended safely. Pass the
+    result with **query.params(), e.g. rocket.users_list(**LEAN_USER.where(active=True).params())."""
+
+    def __init__(self, fields=None, query=None, sort=None):
+        self.fields = dict(fields or {})
+        self.query = dict(query or {})
+        self.sort = dict(sort or {})
+
+    def __repr__(self):
+        return 'Query(fields={}, query={}, sort={})'.format(self.fields, self.query, self.sort)
+
+    def only(self, *names):
+        """Projects the result down to these fields."""
+        return Query(dict(self.fields, **{name: 1 for name in names}), self.query, self.sort)
+
+    def exclude(self, *names):
+        """Leaves these fields out of the result."""
+        return Query(dict(self.fields, **{name: 0 for name in names}), self.query, self.sort)
+
+    def where(self, conditions=None, **equals):
+        """Adds filter conditions, either a MongoDB style dict or field=value pairs."""
+        return Query(self.fields, dict(self.query, **dict(conditions or {}, **equals)), self.sort)
+
+    def order_by(self, *keys):
+        """Sorts by these fields, ascending unless the name starts with '-'."""
+        sort = dict(self.sort)
+        for key in keys:
+            if key.startswith('-'):
+                sort[key[1:]] = -1
+            else:
+                sort[key] = 1
+        return Query(self.fields, self.query, sort)
+
+    def params(self):
+        """The non-empty parts as JSON encoded keyword arguments for a client method."""
+        return {name: json.dumps(value, separators=(',', ':'))
+                for name, value in (('fields', self.fields), ('query', self.query), ('sort', self.sort))
+                if value}
+
+
+LEAN_USER = Query().only('_id', 'username')
+LEAN_ROOM = Query().only('_id', 'name', 't')
@@ -0,0 +1,264 @@
+# -*-coding:utf-8-*-
+import asyncio
+import itertools
+import json
+import logging
+
+import aiohttp
+from rocketchat_API.APIExceptions.RocketExceptions import RocketAuthenticationException, RocketConnectionException
+from rocketchat_API.rocketchat_async import decoded_responses
+
+logger = logging.getLogger(__name__)
+
+ROOMS = 'rooms'
+USERS = 'users'
+SUBSCRIPTIONS = 'subscriptions'
+
+# Status numbers of the user-status event
+STATUSES = ('offline', 'online', 'away', 'busy')
+
+
+class RealtimeCache:
+    """Long-lived cache of rooms_info, users_info and subscriptions_get_one of the async client.
+
+    Entries never expire, a NotifyFeed evicts or patches them as the server reports changes. Only
+    entries that are cached are touched; a fetch racing with a change of the same entry is returned
+    but not cached."""
+
+    def __init__(self, rocket):
+        self.rocket = rocket
+        self._entries = {ROOMS: {}, USERS: {}, SUBSCRIPTIONS: {}}
+        self._usernames = {}
+        # Changes seen per entry while it is being fetched
+        self._fetching = {}
+        self._versions = {}
+        self._epoch = 0
+        self._stats = {'hits': 0, 'misses': 0, 'patches': 0, 'evictions': 0, 'events': 0}
+
+    async def __get(self, kind, key, fetch, field):
+        entries = self._entries[kind]
+        if key in entries:
+            self._stats['hits'] += 1
+            return entries[key]
+        self._stats['misses'] += 1
+        marker = (kind, key)
+        self._fetching[marker] = self._fetching.get(marker, 0) + 1
+        version = (self._epoch, self._versions.get(marker, 0))
+        try:
+            with decoded_responses():
+                result = await fetch()
+        finally:
+            unchanged = version == (self._epoch, self._versions.get(marker, 0))
+            self._fetching[marker] -= 1
+            if not self._fetching[marker]:
+                del self._fetching[marker]
+                self._versions.pop(marker, None)
+        if not result.get('success'):
+            raise RocketConnectionException(result)
+        value = result.get(field)
+        if unchanged:
+            entries[key] = value
+        return value
+
+    async def room(self, room_id):
+        """The room of rooms_info(room_id)."""
+        return await self.__get(ROOMS, room_id, lambda: self.rocket.rooms_info(room_id=room_id), 'room')
+
+    async def subscription(self, room_id):
+        """The caller's subscription of subscriptions_get_one(room_id)."""
+        return await self.__get(SUBSCRIPTIONS, room_id, lambda: self.rocket.subscriptions_get_one(room_id),
+                                'subscription')
+
+    async def user(self, user_id=None, username=None):
+        """The user of users_info, by id or username."""
+        if user_id is None:
+            user_id = self._usernames.get(username)
+        if user_id is None:
+            with decoded_responses():
+                result = await self.rocket.users_info(username=username)
+            if not result.get('success'):
+                raise RocketConnectionException(result)
+            user_id = result['user']['_id']
+            self._usernames[username] = user_id
+        user = await self.__get(USERS, user_id, lambda: self.rocket.users_info(user_id=user_id), 'user')
+        if user.get('username'):
+            self._usernames[user['username']] = user_id
+        return user
+
+    def __touch(self, kind, key):
+        if (kind, key) in self._fetching:
+            self._versions[(kind, key)] = self._versions.get((kind, key), 0) + 1
+
+    def evict(self, kind, key):
+        self.__touch(kind, key)
+        if self._entries[kind].pop(key, None) is not None:
+            self._stats['evictions'] += 1
+
+    def patch(self, kind, key, fields):
+        self.__touch(kind, key)
+        entry = self._entries[kind].get(key)
+        if entry is not None:
+            self._entries[kind][key] = dict(entry, **fields)
+            self._stats['patches'] += 1
+
+    def clear(self):
+        """Drops every entry, for when changes may have been missed."""
+        self._epoch += 1
+        for entries in self._entries.values():
+            entries.clear()
+
+    def apply(self, event, args):
+        """Applies a notify event: event is its name without the user id prefix, args its arguments."""
+        self._stats['events'] += 1
+        if event in ('rooms-changed', 'subscriptions-changed'):
+            action, record = args[0], args[1]
+            kind, key = (ROOMS, record.get('_id')) if event == 'rooms-changed' else (SUBSCRIPTIONS, record.get('rid'))
+            if action == 'removed':
+                self.evict(kind, key)
+            else:
+                self.patch(kind, key, record)
+        elif event == 'Users:NameChanged':
+            user = args[0]
+            self.patch(USERS, user['_id'], {field: user[field] for field in ('name', 'username') if field in user})
+            if user.get('username'):
+                self._usernames[user['username']] = user['_id']
+        elif event == 'Users:Deleted':
+            self.evict(USERS, args[0].get('userId'))
+        elif event == 'user-status':
+            user_id, _, status = args[0][:3]
+            self.patch(USERS, user_id, {'status': STATUSES[status] if isinstance(status, int) else status})
+        elif event == 'updateAvatar':
+            user_id = self._usernames.get(args[0].get('username'))
+            if user_id is not None:
+                self.patch(USERS, user_id, {'avatarETag': args[0].get('etag')})
+        elif event == 'roles-change':
+            user = args[0].get('u') or {}
+            self.evict(USERS, user.get('_id'))
+
+    def metrics(self):
+        return dict(self._stats, **{kind: len(entries) for kind, entries in self._entries.items()})
+
+
+class NotifyFeed:
+    """Keeps a RealtimeCache correct from the server's realtime (DDP over websocket) API.
+
+    Subscribes to the logged in user's rooms-changed and subscriptions-changed events of
+    stream-notify-user and to the user events of stream-notify-logged, and applies every event to
+    the cache. url defaults to the client's server_url with ws/wss and /websocket. Events missed
+    while disconnected can't be replayed, so the cache is cleared on every (re)connect; reconnects
+    back off from retry_delay to max_retry_delay seconds."""
+
+    USER_EVENTS = ('rooms-changed', 'subscriptions-changed')
+    LOGGED_EVENTS = ('Users:NameChanged', 'Users:Deleted', 'user-status', 'updateAvatar', 'roles-change')
+
+    def __init__(self, rocket, cache, url=None, retry_delay=1.0, max_retry_delay=60.0):
+        self.rocket = rocket
+        self.cache = cache
+        self.url = url or rocket.server_url.replace('http', 'ws', 1).rstrip('/') + '/websocket'
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.reconnects = 0
+        self.connected = asyncio.Event()
+        self._ids = itertools.count(1)
+        self._task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.__run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.connected.clear()
+
+    async def wait_connected(self, timeout=None):
+        """Waits until the feed is subscribed, returns False if timeout expired first."""
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def __run(self):
+        delay = self.retry_delay
+        while True:
+            try:
+                async with self.rocket.session.ws_connect(self.url, ssl=self.rocket.ssl_verify) as ws:
+                    await self.__subscribe(ws)
+                    delay = self.retry_delay
+                    await self.__listen(ws)
+            except RocketAuthenticationException as e:
+                logger.error('notify feed to %s stopped, login refused: %s', self.url, e)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError, RocketConnectionException) as e:
+                logger.warning('notify feed to %s disconnected: %s', self.url, e)
+            self.connected.clear()
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(self.max_retry_delay, delay * 2)
+
+    async def __send(self, ws, **message):
+        await ws.send_str(json.dumps(message))
+
+    async def __receive(self, ws):
+        message = await ws.receive()
+        if message.type != aiohttp.WSMsgType.TEXT:
+            raise RocketConnectionException('websocket closed ({})'.format(message.type.name))
+        payload = json.loads(message.data)
+        if payload.get('msg') == 'ping':
+            await self.__send(ws, msg='pong', **({'id': payload['id']} if 'id' in payload else {}))
+        return payload
+
+    async def __subscribe(self, ws):
+        await self.__send(ws, msg='connect', version='1', support=['1'])
+        login_id = str(next(self._ids))
+        await self.__send(ws, msg='method', method='login', id=login_id,
+                          params=[{'resume': self.rocket.headers.get('X-Auth-Token')}])
+        user_id = self.rocket.headers.get('X-User-Id')
+        subscriptions = [('stream-notify-user', '{}/{}'.format(user_id, event)) for event in self.USER_EVENTS]
+        subscriptions += [('stream-notify-logged', event) for event in self.LOGGED_EVENTS]
+        waiting = set()
+        while True:
+            payload = await self.__receive(ws)
+            if payload.get('msg') == 'result' and payload.get('id') == login_id:
+                if payload.get('error'):
+                    raise RocketAuthenticationException(payload['error'])
+                for name, event in subscriptions:
+                    sub_id = str(next(self._ids))
+                    waiting.add(sub_id)
+                    await self.__send(ws, msg='sub', id=sub_id, name=name, params=[event, False])
+            elif payload.get('msg') == 'ready' and waiting:
+                waiting.difference_update(payload.get('subs', []))
+                if not waiting:
+                    break
+            elif payload.get('msg') == 'nosub':
+                raise RocketConnectionException('subscription refused: {}'.format(payload.get('error')))
+        self.cache.clear()
+        self.connected.set()
+
+    async def __listen(self, ws):
+        while True:
+            payload = await self.__receive(ws)
+            if payload.get('msg') != 'changed':
+                continue
+            fields = payload.get('fields', {})
+            event = fields.get('eventName', '').split('/')[-1]
+            try:
+                self.cache.apply(event, fields.get('args', []))
+            except (KeyError, IndexError, TypeError, AttributeError) as e:
+                # A malformed event may concern any entry
+                logger.warning('unexpected %s event %s, clearing cache: %s', event, fields.get('args'), e)
+                self.cache.clear()
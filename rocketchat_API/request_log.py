@@ -0,0 +1,29 @@
+# -*-coding:utf-8-*-
+import logging
+import random
+
+logger = logging.getLogger('rocketchat_API.requests')
+
+_sample_rate = 1.0
+
+
+def set_sample_rate(rate):
+    """Share of requests (0.0 to 1.0) logged while DEBUG is enabled for the rocketchat_API.requests logger."""
+    global _sample_rate
+    if not 0.0 <= rate <= 1.0:
+        raise ValueError('sample rate must be between 0 and 1')
+    _sample_rate = rate
+
+
+def sampled():
+    """Whether the request about to be sent gets a record. Only a level check while logging is off."""
+    return logger.isEnabledFor(logging.DEBUG) and (_sample_rate >= 1.0 or random.random() < _sample_rate)
+
+
+def record(verb, endpoint, status, duration, size, error=None):
+    """Logs one request. verb, endpoint, status, duration (seconds) and size (response bytes) are also
+    set as attributes of the log record; status is None and error the exception for failed requests."""
+    outcome = status if error is None else type(error).__name__
+    logger.debug('%s %s %s %.1fms %sB', verb, endpoint, outcome, duration * 1000, size,
+                 extra={'verb': verb, 'endpoint': endpoint, 'status': status, 'duration': duration, 'size': size,
+                        'error': error})
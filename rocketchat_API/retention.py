@@ -0,0 +1,101 @@
+# -*-coding:utf-8-*-
+import datetime
+import json
+import os
+import threading
+
+
+def to_iso(moment):
+    """Formats a datetime the way rooms.cleanHistory expects it, naive datetimes are taken as UTC."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class RetentionCheckpoint:
+    """JSON file recording how far each room of a retention sweep got, so a restarted sweep resumes.
+
+    Progress only carries over while the sweep's oldest/latest range stays the same."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._rooms = {}
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self._rooms = json.load(checkpoint_file)
+
+    def get(self, room_id, oldest, latest):
+        entry = self._rooms.get(room_id)
+        if entry is None or entry['oldest'] != to_iso(oldest) or entry['latest'] != to_iso(latest):
+            return None
+        return entry
+
+    def save(self, room_id, oldest, latest, done_until, removed, finished):
+        with self._lock:
+            self._rooms[room_id] = {
+                'oldest': to_iso(oldest),
+                'latest': to_iso(latest),
+                'done_until': to_iso(done_until),
+                'removed': removed,
+                'finished': finished,
+            }
+            # Written to a temporary file first so a crash never leaves a truncated checkpoint
+            with open(self.path + '.tmp', 'w') as checkpoint_file:
+                json.dump(self._rooms, checkpoint_file)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class RoomSweep:
+    """Walks one room's cleanup range in time chunks sized by how fast the server answers.
+
+    A chunk answered in under half of target_latency doubles the next one, one slower than
+    target_latency or timing out halves it. A timeout at min_chunk gives up on the room."""
+
+    def __init__(self, room_id, oldest, latest, checkpoint=None, initial_chunk=datetime.timedelta(days=1),
+                 min_chunk=datetime.timedelta(minutes=1), max_chunk=datetime.timedelta(days=90),
+                 target_latency=5.0):
+        self.room_id = room_id
+        self.oldest = oldest
+        self.latest = latest
+        self.checkpoint = checkpoint
+        self.chunk = initial_chunk
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.target_latency = target_latency
+        self.cursor = oldest
+        self.removed = 0
+        self.chunks = 0
+        self.finished = False
+        entry = checkpoint.get(room_id, oldest, latest) if checkpoint is not None else None
+        if entry is not None:
+            self.cursor = datetime.datetime.strptime(entry['done_until'], '%Y-%m-%dT%H:%M:%S.%fZ')
+            if oldest.tzinfo is not None:
+                self.cursor = self.cursor.replace(tzinfo=datetime.timezone.utc)
+            self.removed = entry['removed']
+            self.finished = entry['finished']
+        self._chunk_end = None
+
+    def next_chunk(self):
+        """(oldest, latest) ISO strings of the next chunk to clean."""
+        self._chunk_end = min(self.cursor + self.chunk, self.latest)
+        return to_iso(self.cursor), to_iso(self._chunk_end)
+
+    def done(self, latency, removed):
+        """Records a cleaned chunk, its response time and how many messages it removed."""
+        self.chunks += 1
+        self.removed += removed
+        self.cursor = self._chunk_end
+        self.finished = self.cursor >= self.latest
+        if latency < self.target_latency / 2:
+            self.chunk = min(self.max_chunk, self.chunk * 2)
+        elif latency > self.target_latency:
+            self.chunk = max(self.min_chunk, self.chunk / 2)
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.room_id, self.oldest, self.latest, self.cursor, self.removed, self.finished)
+
+    def timed_out(self, error):
+        """Halves the chunk after a timeout, re-raises error when it can't shrink any further."""
+        if self.chunk <= self.min_chunk:
+            raise error
+        self.chunk = max(self.min_chunk, self.chunk / 2)
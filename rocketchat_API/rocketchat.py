@@ -1,14 +1,28 @@
 # -*-coding:utf-8-*-
-import logging
+import contextvars
+import json
 import mimetypes
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from rocketchat_API import request_log
 from rocketchat_API.APIExceptions.RocketExceptions import RocketConnectionException, RocketAuthenticationException, \
-    RocketMissingParamException
-
-logging.basicConfig(level=logging.WARNING,
-                    format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    RocketMissingParamException, RocketClientClosedException, RocketDeadlineException
+from rocketchat_API.batch import Batch
+from rocketchat_API.fanout import iterate_futures, paced
+from rocketchat_API.lifecycle import RoomOutcome, is_stale, method_for, room_key
+from rocketchat_API.permissions import PermissionIndex
+from rocketchat_API.presence import OFFLINE, PresenceTable
+from rocketchat_API.retention import RoomSweep
+from rocketchat_API.settings import SettingsSnapshot
+from rocketchat_API.timeouts import Timeout, effective_timeout
+from rocketchat_API.watcher import HISTORY_METHODS, RoomWatcher
 
 
 class RocketChat:
@@ -16,19 +30,56 @@ class RocketChat:
 
     def __init__(self, user=None, password=None, auth_token=None, user_id=None,
                  server_url='http://127.0.0.1:3000', ssl_verify=True, proxies=None,
-                 timeout=30):
-        """Creates a RocketChat object and does login on the specified server"""
+                 timeout=30, max_workers=10, session=None, limiter=None, coalesce_reads=False):
+        """Creates a RocketChat object and does login on the specified server
+
+        timeout is either a number of seconds for both connecting and reading or a Timeout."""
+        self._created_at = time.monotonic()
+        self.bootstrapped = {}
+        self.permissions = None
         self.server_url = server_url
         self.proxies = proxies
         self.ssl_verify = ssl_verify
         self.timeout = timeout
+        self.max_workers = max_workers
+        self.limiter = limiter
+        self.coalesce_reads = coalesce_reads
+        self._owns_session = session is None
+        self.session = session or self.__create_session(max_workers)
         self.headers = {}
+        self._headers_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._pool_thread = threading.local()
+        self._inflight_reads = {}
+        self._inflight_lock = threading.Lock()
+        self._requests = threading.Condition()
+        self._requests_in_flight = 0
+        self._open_files = 0
+        self.closed = False
         if user and password:
             self.login(user, password)
         if auth_token and user_id:
+            self.__set_auth_headers(auth_token, user_id)
+
+    @staticmethod
+    def __create_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def __set_auth_headers(self, auth_token, user_id):
+        with self._headers_lock:
             self.headers['X-Auth-Token'] = auth_token
             self.headers['X-User-Id'] = user_id
 
+    def __get_headers(self):
+        # Every request gets its own copy so a concurrent login can't change headers mid-request
+        with self._headers_lock:
+            return dict(self.headers)
+
     @staticmethod
     def __reduce_kwargs(kwargs):
         if 'kwargs' in kwargs:
@@ -38,16 +89,97 @@ class RocketChat:
             del kwargs['kwargs']
         return kwargs
 
+    def __timeout(self):
+        default = self.timeout if isinstance(self.timeout, Timeout) else Timeout(self.timeout, self.timeout)
+        return effective_timeout(default).as_requests()
+
+    def __request(self, verb, url, **kwargs):
+        with self._requests:
+            if self.closed:
+                raise RocketClientClosedException('client is closed')
+            self._requests_in_flight += 1
+        sampled = request_log.sampled()
+        start = time.monotonic() if sampled else 0
+        try:
+            response = self.__send(verb, url, **kwargs)
+        except Exception as e:
+            if sampled:
+                request_log.record(verb, self.__endpoint(url), None, time.monotonic() - start, 0, e)
+            raise
+        finally:
+            with self._requests:
+                self._requests_in_flight -= 1
+                self._requests.notify_all()
+        if sampled:
+            request_log.record(verb, self.__endpoint(url), response.status_code, time.monotonic() - start,
+                               len(response.content))
+        return response
+
+    def __endpoint(self, url):
+        return url[len(self.server_url + self.API_path):].split('?')[0]
+
+    def __send(self, verb, url, **kwargs):
+        if self.limiter is None:
+            kwargs['timeout'] = self.__timeout()
+            return self.session.request(verb, url, verify=self.ssl_verify, proxies=self.proxies, **kwargs)
+        self.limiter.acquire()
+        try:
+            # Computed once the limiter lets the call through so time spent queueing counts against the deadline
+            kwargs['timeout'] = self.__timeout()
+        except RocketDeadlineException:
+            self.limiter.abandon()
+            raise
+        start = time.monotonic()
+        status = None
+        try:
+            response = self.session.request(verb, url, verify=self.ssl_verify, proxies=self.proxies, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.limiter.release(time.monotonic() - start, status)
+
+    @contextmanager
+    def __open_file(self, path):
+        with open(path, 'rb') as upload:
+            with self._requests:
+                self._open_files += 1
+            try:
+                yield upload
+            finally:
+                with self._requests:
+                    self._open_files -= 1
+
+    def __coalesced_get(self, url, headers):
+        # Single-flight: concurrent identical GETs wait for the first one and share its response
+        key = (url, headers.get('X-User-Id'))
+        with self._inflight_lock:
+            future = self._inflight_reads.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight_reads[key] = future
+        if not leader:
+            return future.result()
+        try:
+            response = self.__request('GET', url, headers=headers)
+        except BaseException as e:
+            with self._inflight_lock:
+                del self._inflight_reads[key]
+            future.set_exception(e)
+            raise
+        with self._inflight_lock:
+            del self._inflight_reads[key]
+        future.set_result(response)
+        return response
+
     def __call_api_get(self, method, **kwargs):
         args = self.__reduce_kwargs(kwargs)
-        return requests.get(self.server_url + self.API_path + method + '?' +
-                            '&'.join([i + '=' + str(args[i])
-                                      for i in args.keys()]),
-                            headers=self.headers,
-                            verify=self.ssl_verify,
-                            proxies=self.proxies,
-                            timeout=self.timeout
-                            )
+        url = self.server_url + self.API_path + method + '?' + urlencode([(i, str(args[i])) for i in args.keys()])
+        if self.coalesce_reads:
+            return self.__coalesced_get(url, self.__get_headers())
+        return self.__request('GET', url,
+                              headers=self.__get_headers()
+                              )
 
     def __call_api_post(self, method, files=None, use_json=True, **kwargs):
         reduced_args = self.__reduce_kwargs(kwargs)
@@ -56,39 +188,178 @@ class RocketChat:
         if 'password' in reduced_args and method != 'users.create':
             reduced_args['pass'] = reduced_args['password']
         if use_json:
-            return requests.post(self.server_url + self.API_path + method,
-                                 json=reduced_args,
-                                 files=files,
-                                 headers=self.headers,
-                                 verify=self.ssl_verify,
-                                 proxies=self.proxies,
-                                 timeout=self.timeout
-                                 )
+            return self.__request('POST', self.server_url + self.API_path + method,
+                                  json=reduced_args,
+                                  files=files,
+                                  headers=self.__get_headers()
+                                  )
         else:
-            return requests.post(self.server_url + self.API_path + method,
-                                 data=reduced_args,
-                                 files=files,
-                                 headers=self.headers,
-                                 verify=self.ssl_verify,
-                                 proxies=self.proxies,
-                                 timeout=self.timeout
-                                 )
+            return self.__request('POST', self.server_url + self.API_path + method,
+                                  data=reduced_args,
+                                  files=files,
+                                  headers=self.__get_headers()
+                                  )
+
+    # Lifecycle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self, timeout=None):
+        """Stops accepting calls, waits up to timeout seconds for the requests in flight to finish and
+        releases the worker threads and pooled connections. Fan-out calls not started yet are cancelled.
+        A session passed to the constructor is left open."""
+        with self._requests:
+            self.closed = True
+            self._requests.wait_for(lambda: self._requests_in_flight == 0, timeout)
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=timeout is None, cancel_futures=True)
+                self._executor = None
+        if self._owns_session:
+            self.session.close()
+
+    def resources(self):
+        """What the client holds open, to alert on leaks: requests in flight, upload files open and,
+        per connection pool, its size, connections created so far and idle connections kept open.
+        open_sockets adds up idle connections and requests in flight."""
+        pools = []
+        for adapter in set(self.session.adapters.values()):
+            poolmanager = getattr(adapter, 'poolmanager', None)
+            if poolmanager is None:
+                continue
+            for key in poolmanager.pools.keys():
+                pool = poolmanager.pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                idle = [conn for conn in list(pool.pool.queue) if conn is not None and conn.sock is not None]
+                pools.append({
+                    'host': '{}://{}:{}'.format(pool.scheme, pool.host, pool.port),
+                    'size': pool.pool.maxsize,
+                    'created': pool.num_connections,
+                    'idle': len(idle),
+                })
+        with self._requests:
+            in_flight, open_files = self._requests_in_flight, self._open_files
+        return {
+            'closed': self.closed,
+            'in_flight': in_flight,
+            'open_files': open_files,
+            'open_sockets': in_flight + sum(pool['idle'] for pool in pools),
+            'pools': pools,
+        }
+
+    # Fan-out
+
+    def __get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    initializer=self.__mark_pool_thread)
+            return self._executor
+
+    def __mark_pool_thread(self):
+        self._pool_thread.active = True
+
+    def __submit_call(self, func, args, kwargs):
+        # Each call runs in a copy of the caller's context so deadlines and overrides follow it
+        context = contextvars.copy_context()
+        if not getattr(self._pool_thread, 'active', False):
+            return self.__get_executor().submit(context.run, func, *args, **kwargs)
+        # Fan-out from a pool thread (a snapshot run through map, submit, batch or warmup) runs in that
+        # thread: waiting on the pool from its own threads deadlocks once all of them do it
+        future = Future()
+        try:
+            future.set_result(context.run(func, *args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __resolve_method(self, method):
+        if callable(method):
+            return method
+        return getattr(self, method)
+
+    def submit(self, method, *args, **kwargs):
+        """Runs a client method (name or bound method) on the shared thread pool and returns its Future.
+        Called from a pool thread, the method runs right away in that thread."""
+        return self.__submit_call(self.__resolve_method(method), args, kwargs)
+
+    def map(self, method, arg_sets, ordered=True, max_in_flight=None):
+        """Runs a client method over many argument sets on the shared thread pool.
+
+        Each argument set is a dict of keyword arguments, a tuple of positional arguments or a single
+        positional argument. Yields a FanOutResult per item, in input order or as they complete when
+        ordered is False. Errors are captured on the result instead of being raised. arg_sets is
+        consumed lazily and at most max_in_flight (default max_workers) calls are pending at a time.
+        Called from a pool thread, e.g. by a method itself run through map, the calls run one at a time
+        in that thread."""
+        func = self.__resolve_method(method)
+
+        def submit(args, kwargs):
+            return self.__submit_call(func, args, kwargs)
+
+        return iterate_futures(submit, arg_sets, ordered, max_in_flight or self.max_workers)
+
+    # Batches
+
+    def batch(self):
+        """Context manager queueing the calls made through it and running them concurrently on exit.
+
+        Calls return futures; a future or a Ref into its result (future['channel']['_id']) passed to
+        a later call makes that call wait for it. See Batch."""
+        return Batch(self)
+
+    # Warm-up
+
+    def warmup(self, connections=4, bootstrap=('me', 'info', 'rooms_get')):
+        """Opens pooled connections and runs bootstrap calls concurrently, reporting time-to-ready.
+
+        bootstrap holds client method names or (name, kwargs) tuples, e.g. 'permissions_index' to build
+        a PermissionIndex. connections requests (at most max_workers, the pool size) are sent together,
+        bootstrap calls topped up with info calls, so that many connections are open afterwards. The
+        bootstrap results are kept in bootstrapped by method name, a PermissionIndex also in
+        permissions. Returns a dict with the bootstrap results, their latencies and errors (which are
+        not raised), the warm-up duration and time_to_ready, the seconds since the client was created."""
+        started = time.monotonic()
+        calls = [call if isinstance(call, tuple) else (call, {}) for call in bootstrap]
+        calls += [('info', {})] * (min(connections, self.max_workers) - len(calls))
+
+        def timed(name, kwargs):
+            call_started = time.monotonic()
+            return getattr(self, name)(**kwargs), time.monotonic() - call_started
+
+        futures = [self.submit(timed, name, kwargs) for name, kwargs in calls]
+        report = {'connections': len(calls), 'results': {}, 'latency': {}, 'errors': {}}
+        for (name, _), future in zip(calls[:len(bootstrap)], futures):
+            if future.exception() is not None:
+                report['errors'][name] = future.exception()
+            else:
+                report['results'][name], report['latency'][name] = future.result()
+        wait(futures)
+        self.bootstrapped.update(report['results'])
+        if isinstance(report['results'].get('permissions_index'), PermissionIndex):
+            self.permissions = report['results']['permissions_index']
+        report['warmup'] = time.monotonic() - started
+        report['time_to_ready'] = time.monotonic() - self._created_at
+        return report
 
     # Authentication
 
     def login(self, user, password):
-        login_request = requests.post(self.server_url + self.API_path + 'login',
-                                      data={'username': user,
-                                            'password': password},
-                                      verify=self.ssl_verify,
-                                      proxies=self.proxies)
+        login_request = self.__request('POST', self.server_url + self.API_path + 'login',
+                                       data={'username': user,
+                                             'password': password})
         if login_request.status_code == 401:
             raise RocketAuthenticationException()
 
         if login_request.status_code == 200:
             if login_request.json().get('status') == "success":
-                self.headers['X-Auth-Token'] = login_request.json().get('data').get('authToken')
-                self.headers['X-User-Id'] = login_request.json().get('data').get('userId')
+                self.__set_auth_headers(login_request.json().get('data').get('authToken'),
+                                        login_request.json().get('data').get('userId'))
                 return login_request
             else:
                 raise RocketAuthenticationException()
@@ -112,7 +383,7 @@ class RocketChat:
     def directory(self, query, **kwargs):
         """Search by users or channels on all server."""
         if isinstance(query, dict):
-            query = str(query).replace("'", '"')
+            query = json.dumps(query)
 
         return self.__call_api_get('directory', query=query, kwargs=kwargs)
 
@@ -152,6 +423,37 @@ class RocketChat:
         else:
             raise RocketMissingParamException('userID or username required')
 
+    def users_presence(self, from_date=None, ids=None, **kwargs):
+        """Gets the presence of all users not offline, or of the ones changed since from_date."""
+        if from_date:
+            kwargs['from'] = from_date
+        if ids:
+            kwargs['ids'] = ','.join(ids)
+        return self.__call_api_get('users.presence', kwargs=kwargs)
+
+    def users_presence_snapshot(self, table=None, user_ids=None):
+        """Refreshes a PresenceTable (a new one for user_ids if none is given) and returns it.
+
+        Uses a single users.presence call, fetching only changes since the previous refresh. Servers
+        without users.presence get concurrent users_get_presence calls for the table's user_ids."""
+        table = table if table is not None else PresenceTable(user_ids)
+        if table.bulk_supported is not False:
+            cursor = table.next_cursor()
+            response = self.users_presence(from_date=table.cursor)
+            if response.status_code == 200:
+                table.bulk_supported = True
+                table.apply(response.json(), cursor)
+                return table
+            if response.status_code != 404:
+                raise RocketConnectionException(response.text)
+            table.bulk_supported = False
+        if table.user_ids is None:
+            raise RocketMissingParamException('user_ids required on servers without users.presence')
+        for result in self.map('users_get_presence', [{'user_id': user_id} for user_id in table.user_ids]):
+            if result.exception is None and result.result.status_code == 200:
+                table.set(result.arg_set['user_id'], result.result.json().get('presence', OFFLINE))
+        return table
+
     def users_create(self, email, name, password, username, **kwargs):
         """Creates a user"""
         return self.__call_api_post('users.create', email=email, name=name, password=password, username=username,
@@ -180,8 +482,9 @@ class RocketChat:
         if avatar_url.startswith('http://') or avatar_url.startswith('https://'):
             return self.__call_api_post('users.setAvatar', avatarUrl=avatar_url, kwargs=kwargs)
         else:
-            avatar_file = {"image": open(avatar_url, "rb")}
-            return self.__call_api_post('users.setAvatar', files=avatar_file, kwargs=kwargs)
+            with self.__open_file(avatar_url) as avatar:
+                avatar_file = {"image": avatar}
+                return self.__call_api_post('users.setAvatar', files=avatar_file, kwargs=kwargs)
 
     def users_reset_avatar(self, user_id=None, username=None, **kwargs):
         """Reset a user’s avatar"""
@@ -335,6 +638,12 @@ class RocketChat:
         """Removes a user from the channel."""
         return self.__call_api_post('channels.kick', roomId=room_id, userId=user_id, kwargs=kwargs)
 
+    def channels_join(self, room_id, join_code=None, **kwargs):
+        """Joins yourself to the channel, join_code is needed if the channel has one."""
+        if join_code:
+            return self.__call_api_post('channels.join', roomId=room_id, joinCode=join_code, kwargs=kwargs)
+        return self.__call_api_post('channels.join', roomId=room_id, kwargs=kwargs)
+
     def channels_leave(self, room_id, **kwargs):
         """Causes the callee to be removed from the channel."""
         return self.__call_api_post('channels.leave', roomId=room_id, kwargs=kwargs)
@@ -616,18 +925,56 @@ class RocketChat:
         """Updates the setting for the provided _id."""
         return self.__call_api_post('settings/' + _id, value=value)
 
-    def settings(self):
+    def settings(self, **kwargs):
         """List all private settings."""
-        return self.__call_api_get('settings')
+        return self.__call_api_get('settings', kwargs=kwargs)
+
+    def settings_snapshot(self, page_size=100):
+        """Pulls all private settings into a SettingsSnapshot.
+
+        The first page tells how many settings there are, the remaining pages are fetched concurrently."""
+        response = self.settings(count=page_size, offset=0)
+        if response.status_code != 200:
+            raise RocketConnectionException(response.text)
+        first = response.json()
+        snapshot = SettingsSnapshot(first.get('settings', []))
+        pages = [{'count': page_size, 'offset': offset}
+                 for offset in range(page_size, first.get('total', 0), page_size)]
+        for result in self.map('settings', pages):
+            if result.exception is not None:
+                raise result.exception
+            if result.result.status_code != 200:
+                raise RocketConnectionException(result.result.text)
+            snapshot.extend(result.result.json().get('settings', []))
+        return snapshot
+
+    def settings_apply(self, desired, snapshot=None, concurrency=None, rate=None):
+        """Brings the server's settings to desired, a dict of _id to value.
+
+        Only settings whose value differs from snapshot (pulled with settings_snapshot if not given)
+        are updated, with at most concurrency updates in flight and, if rate is given, at most rate
+        updates started a second. Returns a FanOutResult per update in the order they finished, with
+        (_id, value) as arg_set; the snapshot is updated for every successful one."""
+        snapshot = snapshot if snapshot is not None else self.settings_snapshot()
+        changes = snapshot.diff(desired).items()
+        if rate:
+            changes = paced(changes, rate)
+        results = []
+        for result in self.map('settings_update', changes, ordered=False, max_in_flight=concurrency):
+            if result.exception is None and result.result.status_code == 200:
+                snapshot.set(*result.arg_set)
+            results.append(result)
+        return results
 
     # Rooms
 
     def rooms_upload(self, rid, file, **kwargs):
         """Post a message with attached file to a dedicated room."""
-        files = {
-            'file': open(file, 'rb')
-        }
-        return self.__call_api_post('rooms.upload/' + rid, kwargs=kwargs, use_json=False, files=files)
+        with self.__open_file(file) as upload:
+            files = {
+                'file': upload
+            }
+            return self.__call_api_post('rooms.upload/' + rid, kwargs=kwargs, use_json=False, files=files)
 
     def rooms_get(self, **kwargs):
         """Get all opened rooms for this user."""
@@ -637,6 +984,57 @@ class RocketChat:
         """Cleans up a room, removing messages from the provided time range."""
         return self.__call_api_post('rooms.cleanHistory', roomId=room_id, latest=latest, oldest=oldest, kwargs=kwargs)
 
+    def __sweep_room(self, room_id, oldest, latest, checkpoint, chunk_options):
+        sweep = RoomSweep(room_id, oldest, latest, checkpoint, **chunk_options)
+        while not sweep.finished:
+            chunk_oldest, chunk_latest = sweep.next_chunk()
+            start = time.monotonic()
+            try:
+                response = self.rooms_clean_history(room_id, latest=chunk_latest, oldest=chunk_oldest, inclusive=True)
+            except requests.exceptions.Timeout as e:
+                sweep.timed_out(e)
+                continue
+            if response.status_code != 200:
+                raise RocketConnectionException('cleaning {} failed: {}'.format(room_id, response.text))
+            sweep.done(time.monotonic() - start, response.json().get('count', 0))
+        return sweep.removed
+
+    def rooms_clean_history_sweep(self, room_ids, oldest, latest, checkpoint=None, concurrency=None,
+                                  **chunk_options):
+        """Cleans the history of many rooms between oldest and latest (datetimes) in adaptive time chunks.
+
+        Rooms are swept concurrently, at most concurrency (default the client's limit) at a time,
+        each one chunk after another so no single call covers more than the server handles quickly.
+        With a RetentionCheckpoint a restarted sweep resumes where it stopped. chunk_options go to
+        RoomSweep. Yields a FanOutResult per room, as rooms finish, with the messages removed."""
+        def sweep(room_id):
+            return self.__sweep_room(room_id, oldest, latest, checkpoint, chunk_options)
+
+        return self.map(sweep, room_ids, ordered=False, max_in_flight=concurrency)
+
+    def rooms_stale(self, older_than):
+        """Rooms of rooms_get (channels and groups only) without activity since older_than, an aware datetime."""
+        response = self.rooms_get()
+        if response.status_code != 200:
+            raise RocketConnectionException(response.text)
+        return (room for room in response.json().get('update', []) if is_stale(room, older_than))
+
+    def rooms_lifecycle(self, action, rooms, concurrency=None, **kwargs):
+        """Applies a lifecycle action (archive, unarchive, delete or set_type) to many rooms concurrently.
+
+        rooms are room dicts, as from rooms_stale, or (room_id, type) tuples; each one is handled by
+        the channels_ or groups_ method matching its type and kwargs are passed on (e.g. a_type for
+        set_type). At most concurrency calls run at a time. Yields a RoomOutcome per room as they finish."""
+        def apply(room):
+            room_id, room_type = room_key(room)
+            return getattr(self, method_for(action, room_type))(room_id, **kwargs)
+
+        for result in self.map(apply, ((room,) for room in rooms), ordered=False, max_in_flight=concurrency):
+            room_id, room_type = room_key(result.arg_set[0])
+            response = result.result
+            success = response is not None and response.status_code == 200 and response.json().get('success', False)
+            yield RoomOutcome(room_id, room_type, action, success, response, result.exception)
+
     def rooms_favorite(self, room_id=None, room_name=None, favorite=True):
         """Favorite or unfavorite room."""
         if room_id is not None:
@@ -669,16 +1067,90 @@ class RocketChat:
         """Mark messages as unread by roomId or from a message"""
         return self.__call_api_post('subscriptions.unread', roomId=room_id, kwargs=kwargs)
 
+    def rooms_history_since(self, room_id, room_type, oldest, count=100):
+        """All messages of a room newer than oldest, oldest first, fetched count at a time."""
+        method = getattr(self, HISTORY_METHODS[room_type])
+        messages = []
+        kwargs = {'oldest': oldest, 'count': count}
+        while True:
+            response = method(room_id, **kwargs)
+            if response.status_code != 200:
+                raise RocketConnectionException(response.text)
+            page = response.json().get('messages', [])
+            messages.extend(page)
+            if len(page) < count:
+                break
+            # Pages go from the newest message backwards
+            kwargs['latest'] = page[-1]['ts']
+        messages.reverse()
+        return messages
+
+    def rooms_watch(self, rooms=None, watcher=None, count=100, concurrency=None):
+        """Polls rooms for new messages and yields them, oldest first per room, until closed.
+
+        rooms are room dicts or (room_id, type) tuples, by default every room the user is subscribed
+        to (kept up to date as subscriptions change). Each cycle makes one subscriptions_get call with
+        updatedSince to find the rooms with activity and only polls those, at most concurrency at a
+        time, plus idle rooms whose safety poll is due. watcher is a RoomWatcher holding intervals,
+        cursors and metrics, a new one if none is given. When subscriptions can't be read rooms are
+        polled on their own adaptive schedule."""
+        watcher = watcher if watcher is not None else RoomWatcher()
+        for room in rooms or ():
+            watcher.add(*room_key(room), now=time.monotonic())
+
+        def poll(room_id):
+            return self.rooms_history_since(room_id, watcher.rooms[room_id]['type'], watcher.cursor(room_id),
+                                            count=count)
+
+        while True:
+            kwargs = {'updatedSince': watcher.subscriptions_cursor} if watcher.subscriptions_cursor else {}
+            response = self.subscriptions_get(**kwargs)
+            changed = None
+            if response.status_code == 200:
+                changed = watcher.apply_subscriptions(response.json(), watch_new=rooms is None, now=time.monotonic())
+            selected = watcher.select(time.monotonic(), changed)
+            for result in self.map(poll, selected, ordered=False, max_in_flight=concurrency):
+                if result.exception is not None:
+                    watcher.failed(result.arg_set, time.monotonic())
+                    continue
+                watcher.polled(result.arg_set, result.result, time.monotonic())
+                for message in result.result:
+                    yield message
+            time.sleep(watcher.sleep_time(time.monotonic(), changed))
+
     # Assets
 
     def assets_set_asset(self, asset_name, file, **kwargs):
         """Set an asset image by name."""
         content_type = mimetypes.MimeTypes().guess_type(file)
-        files = {
-            asset_name: (file, open(file, 'rb'), content_type[0], {'Expires': '0'}),
-        }
-        return self.__call_api_post('assets.setAsset', kwargs=kwargs, use_json=False, files=files)
+        with self.__open_file(file) as asset:
+            files = {
+                asset_name: (file, asset, content_type[0], {'Expires': '0'}),
+            }
+            return self.__call_api_post('assets.setAsset', kwargs=kwargs, use_json=False, files=files)
 
     def assets_unset_asset(self, asset_name):
         """Unset an asset by name"""
         return self.__call_api_post('assets.unsetAsset', assetName=asset_name)
+
+    # Permissions
+
+    def permissions_list(self, **kwargs):
+        """Lists permissions on the server, only the ones changed since updatedSince if given."""
+        return self.__call_api_get('permissions.listAll', kwargs=kwargs)
+
+    def permissions_update(self, permissions):
+        """Edits permissions on the server."""
+        return self.__call_api_post('permissions.update', permissions=permissions)
+
+    def permissions_index(self, index=None):
+        """Refreshes a PermissionIndex (a new one if none is given) and returns it.
+
+        After the first refresh only permissions changed since the previous one are fetched."""
+        index = index if index is not None else PermissionIndex()
+        kwargs = {'updatedSince': index.cursor} if index.cursor else {}
+        response = self.permissions_list(**kwargs)
+        if response.status_code != 200:
+            raise RocketConnectionException(response.text)
+        index.apply(response.json())
+        return index
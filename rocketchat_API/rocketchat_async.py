@@ -1,21 +1,78 @@
 # -*-coding:utf-8-*-
+import asyncio
+import contextvars
+import json
 import logging
 import mimetypes
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlencode
 
 import requests
 
 import aiohttp
 import magic
+from rocketchat_API import request_log
 from rocketchat_API.APIExceptions.RocketExceptions import (
     RocketAuthenticationException,
+    RocketClientClosedException,
     RocketConnectionException,
+    RocketDeadlineException,
     RocketMissingParamException,
 )
+from rocketchat_API.batch import AsyncBatch
+from rocketchat_API.fanout import FanOutResult, apaced, expand_arg_set
+from rocketchat_API.lifecycle import RoomOutcome, is_stale, method_for, room_key
+from rocketchat_API.permissions import PermissionIndex
+from rocketchat_API.presence import OFFLINE, PresenceTable
+from rocketchat_API.retention import RoomSweep
+from rocketchat_API.settings import SettingsSnapshot
+from rocketchat_API.timeouts import Timeout, effective_timeout
+from rocketchat_API.watcher import HISTORY_METHODS, RoomWatcher
 
 MIME = magic.Magic(mime=True)
 
-logging.basicConfig(level=logging.WARNING,
-                    format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+logger = logging.getLogger(__name__)
+
+# None leaves it to the client's raw setting
+_raw = contextvars.ContextVar('rocketchat_API_raw', default=None)
+
+
+@contextmanager
+def raw_responses():
+    """Calls made inside the block return a RawResponse instead of the decoded JSON body."""
+    token = _raw.set(True)
+    try:
+        yield
+    finally:
+        _raw.reset(token)
+
+
+@contextmanager
+def decoded_responses():
+    """Calls made inside the block return the decoded JSON body, even on a raw client."""
+    token = _raw.set(False)
+    try:
+        yield
+    finally:
+        _raw.reset(token)
+
+
+class RawResponse:
+    """Undecoded answer of the server: status code, headers and the body as bytes."""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def view(self):
+        """Zero-copy memoryview over the body."""
+        return memoryview(self.body)
+
+    def json(self):
+        return json.loads(self.body)
 
 
 class RocketChat:
@@ -23,14 +80,38 @@ class RocketChat:
 
     def __init__(self, user=None, password=None, auth_token=None, user_id=None,
                  server_url='http://127.0.0.1:3000', ssl_verify=True, proxies=None,
-                 timeout=30):
-        """Creates a RocketChat object and does login on the specified server"""
+                 timeout=30, max_in_flight=100, endpoint_limits=None, limiter=None, coalesce_reads=False,
+                 hedge=None, scheduler=None, raw=False):
+        """Creates a RocketChat object and does login on the specified server
+
+        timeout is either a number of seconds for the whole call or a Timeout. When a PriorityScheduler
+        is given its slots replace max_in_flight as the client-wide limit. With raw every call returns a
+        RawResponse instead of the decoded JSON body, see also raw_responses(); helpers that read the
+        results (snapshots, indexes, sweeps, rooms_watch, ...) still work on decoded bodies."""
+        self._created_at = time.monotonic()
+        self.bootstrapped = {}
+        self.permissions = None
         self.server_url = server_url
         self.proxies = proxies
         self.ssl_verify = ssl_verify
         self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.limiter = limiter
+        self.coalesce_reads = coalesce_reads
+        self.hedge = hedge
+        self.scheduler = scheduler
+        self.raw = raw
+        self._inflight_reads = {}
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._endpoint_semaphores = {endpoint: asyncio.Semaphore(limit)
+                                     for endpoint, limit in (endpoint_limits or {}).items()}
         self.session = aiohttp.ClientSession()
         self.headers = {}
+        self._requests_in_flight = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._open_files = 0
+        self.closed = False
         if user and password:
             self.login(user, password)
         if auth_token and user_id:
@@ -46,17 +127,152 @@ class RocketChat:
             del kwargs['kwargs']
         return kwargs
 
+    @asynccontextmanager
+    async def __client_slot(self):
+        if self.scheduler is None:
+            async with self._semaphore:
+                yield
+        else:
+            await self.scheduler.acquire()
+            try:
+                yield
+            finally:
+                self.scheduler.release()
+
+    @asynccontextmanager
+    async def __request_slot(self, method):
+        # Endpoints with a path parameter (settings/<id>, rooms.upload/<rid>) share one limit. The
+        # endpoint limit is taken first so calls queued behind it don't hold client-wide slots
+        endpoint_semaphore = self._endpoint_semaphores.get(method.split('/')[0])
+        if endpoint_semaphore is None:
+            async with self.__client_slot():
+                yield
+        else:
+            async with endpoint_semaphore:
+                async with self.__client_slot():
+                    yield
+
+    def __timeout(self):
+        return effective_timeout(self.timeout if isinstance(self.timeout, Timeout) else Timeout(total=self.timeout))
+
+    def __client_timeout(self):
+        timeout = self.__timeout()
+        return aiohttp.ClientTimeout(total=timeout.total, connect=timeout.connect, sock_read=timeout.read)
+
+    def __raw_mode(self):
+        raw = _raw.get()
+        return self.raw if raw is None else raw
+
+    async def __read(self, resp):
+        if self.__raw_mode():
+            return RawResponse(resp.status, resp.headers, await resp.read())
+        return await resp.json()
+
+    async def __request(self, verb, method, url, **kwargs):
+        if self.closed:
+            raise RocketClientClosedException('client is closed')
+        self._requests_in_flight += 1
+        self._drained.clear()
+        try:
+            return await self.__send(verb, method, url, **kwargs)
+        finally:
+            self._requests_in_flight -= 1
+            if not self._requests_in_flight:
+                self._drained.set()
+
+    async def __send(self, verb, method, url, **kwargs):
+        async with self.__request_slot(method):
+            # Computed once a slot is free so time spent queueing counts against the deadline
+            if self.limiter is None:
+                kwargs['timeout'] = self.__client_timeout()
+                return (await self.__exchange(verb, method, url, kwargs))[1]
+            await self.limiter.acquire()
+            try:
+                kwargs['timeout'] = self.__client_timeout()
+            except RocketDeadlineException:
+                self.limiter.abandon()
+                raise
+            start = time.monotonic()
+            status = None
+            try:
+                status, result = await self.__exchange(verb, method, url, kwargs)
+                return result
+            finally:
+                self.limiter.release(time.monotonic() - start, status)
+
+    async def __exchange(self, verb, method, url, kwargs):
+        sampled = request_log.sampled()
+        start = time.monotonic() if sampled else 0
+        try:
+            async with self.session.request(verb, url, ssl=self.ssl_verify, **kwargs) as resp:
+                result = await self.__read(resp)
+                if sampled:
+                    # The body is already buffered, read() returns it without another round trip
+                    request_log.record(verb, method, resp.status, time.monotonic() - start, len(await resp.read()))
+                return resp.status, result
+        except Exception as e:
+            if sampled:
+                request_log.record(verb, method, None, time.monotonic() - start, 0, e)
+            raise
+
+    @contextmanager
+    def __open_file(self, path):
+        with open(path, 'rb') as upload:
+            self._open_files += 1
+            try:
+                yield upload
+            finally:
+                self._open_files -= 1
+
+    async def __send_get(self, method, url):
+        if self.hedge is not None and self.hedge.applies_to(method):
+            return await self.__hedged_get(method, url)
+        return await self.__request('GET', method, url,
+                                    headers=self.headers,
+                                    #proxies=self.proxies
+                                    )
+
+    async def __hedged_get(self, method, url):
+        start = time.monotonic()
+        delay = self.hedge.hedge_delay(method)
+        primary = asyncio.ensure_future(self.__request('GET', method, url, headers=self.headers))
+        tasks = [primary]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.hedge.try_hedge():
+                    tasks.append(asyncio.ensure_future(
+                        self.__request('GET', method, url, headers=self.headers)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.hedge.record(method, time.monotonic() - start)
+                        if task is not primary:
+                            self.hedge.hedge_wins += 1
+                        return task.result()
+            # Every copy failed, surface the primary's error
+            return primary.result()
+        finally:
+            # Whichever copy lost is cancelled
+            for task in tasks:
+                task.cancel()
+
     async def __call_api_get(self, method, **kwargs):
         args = self.__reduce_kwargs(kwargs)
-        async with self.session.get(self.server_url + self.API_path + method + '?' +
-                        '&'.join([i + '=' + str(args[i])
-                                  for i in args.keys()]),
-                        headers=self.headers,
-                        ssl=self.ssl_verify,
-                        #proxies=self.proxies,
-                        timeout=self.timeout
-                        ) as resp:
-            return await resp.json()
+        url = self.server_url + self.API_path + method + '?' + urlencode([(i, str(args[i])) for i in args.keys()])
+        if not self.coalesce_reads:
+            return await self.__send_get(method, url)
+        # Single-flight: concurrent identical GETs share one request and all waiters get its result
+        key = (url, self.headers.get('X-User-Id'), self.__raw_mode())
+        future = self._inflight_reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.__send_get(method, url))
+            self._inflight_reads[key] = future
+            future.add_done_callback(lambda _: self._inflight_reads.pop(key, None))
+        # Shielded so a cancelled waiter doesn't cancel the request the others are waiting on
+        return await asyncio.shield(future)
 
     async def __call_api_post(self, method, files=None, use_json=True, **kwargs):
         reduced_args = self.__reduce_kwargs(kwargs)
@@ -80,23 +296,170 @@ class RocketChat:
                 form_data.add_field(key, value)
 
         if use_json and not form_data:
-            async with self.session.post(self.server_url + self.API_path + method,
-                             json=reduced_args,
-                             headers=self.headers,
-                             ssl=self.ssl_verify,
-                             #proxies=self.proxies,
-                             timeout=self.timeout
-                             ) as resp:
-                return await resp.json()
+            return await self.__request('POST', method, self.server_url + self.API_path + method,
+                                        json=reduced_args,
+                                        headers=self.headers,
+                                        #proxies=self.proxies
+                                        )
         else:
-            async with self.session.post(self.server_url + self.API_path + method,
-                             data=form_data,
-                             headers=self.headers,
-                             ssl=self.ssl_verify,
-                             #proxies=self.proxies,
-                             timeout=self.timeout
-                             ) as resp:
-                return await resp.json()
+            return await self.__request('POST', method, self.server_url + self.API_path + method,
+                                        data=form_data,
+                                        headers=self.headers,
+                                        #proxies=self.proxies
+                                        )
+
+    # Lifecycle
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self, timeout=None):
+        """Stops accepting calls, waits up to timeout seconds for the requests in flight to finish and
+        closes the session with its pooled connections."""
+        self.closed = True
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        await self.session.close()
+
+    def resources(self):
+        """What the client holds open, to alert on leaks: requests in flight, upload files open and the
+        connection pool's limit, connections in use and idle connections kept open. open_sockets adds
+        up connections in use and idle ones."""
+        connector = self.session.connector
+        # aiohttp doesn't expose pool occupancy, it is read from the connector's bookkeeping
+        in_use = len(getattr(connector, '_acquired', ())) if connector is not None else 0
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values()) if connector is not None else 0
+        return {
+            'closed': self.closed,
+            'in_flight': self._requests_in_flight,
+            'open_files': self._open_files,
+            'open_sockets': in_use + idle,
+            'pool': {
+                'size': connector.limit if connector is not None else 0,
+                'in_use': in_use,
+                'idle': idle,
+            },
+        }
+
+    # Fan-out
+
+    def __resolve_method(self, method):
+        if callable(method):
+            return method
+        return getattr(self, method)
+
+    @staticmethod
+    async def __iterate(arg_sets):
+        if hasattr(arg_sets, '__aiter__'):
+            async for arg_set in arg_sets:
+                yield arg_set
+        else:
+            for arg_set in arg_sets:
+                yield arg_set
+
+    @staticmethod
+    async def __run_item(func, index, arg_set):
+        args, kwargs = expand_arg_set(arg_set)
+        try:
+            return FanOutResult(index, arg_set, await func(*args, **kwargs), None)
+        except Exception as e:
+            return FanOutResult(index, arg_set, None, e)
+
+    async def amap(self, method, arg_sets, ordered=True, concurrency=None, fail_fast=False):
+        """Runs a client coroutine method over many argument sets with bounded concurrency.
+
+        Each argument set is a dict of keyword arguments, a tuple of positional arguments or a single
+        positional argument; arg_sets may be a regular or an async iterable and is consumed lazily.
+        Yields a FanOutResult per item, in input order or as they complete when ordered is False.
+        Errors are captured on the result unless fail_fast is set, in which case the remaining calls
+        are cancelled and the first error is raised. At most concurrency (default max_in_flight)
+        calls are scheduled at a time."""
+        func = self.__resolve_method(method)
+        limit = concurrency or self.max_in_flight
+        pending = deque() if ordered else set()
+
+        def check(result):
+            if fail_fast and result.exception is not None:
+                raise result.exception
+            return result
+
+        try:
+            index = 0
+            async for arg_set in self.__iterate(arg_sets):
+                task = asyncio.ensure_future(self.__run_item(func, index, arg_set))
+                index += 1
+                if ordered:
+                    pending.append(task)
+                    while len(pending) >= limit:
+                        yield check(await pending.popleft())
+                else:
+                    pending.add(task)
+                    while len(pending) >= limit:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            yield check(task.result())
+            if ordered:
+                while pending:
+                    yield check(await pending.popleft())
+            else:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield check(task.result())
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def as_completed(self, method, arg_sets, concurrency=None, fail_fast=False):
+        """Same as amap but yields results as soon as they finish."""
+        return self.amap(method, arg_sets, ordered=False, concurrency=concurrency, fail_fast=fail_fast)
+
+    # Batches
+
+    def batch(self):
+        """Context manager queueing the calls made through it and running them concurrently on exit.
+
+        Calls return futures; a future or a Ref into its result (future['channel']['_id']) passed to
+        a later call makes that call wait for it. See AsyncBatch."""
+        return AsyncBatch(self)
+
+    # Warm-up
+
+    async def warmup(self, connections=4, bootstrap=('me', 'info', 'rooms_get')):
+        """Opens pooled connections and runs bootstrap calls concurrently, reporting time-to-ready.
+
+        bootstrap holds client method names or (name, kwargs) tuples, e.g. 'permissions_index' to build
+        a PermissionIndex. connections requests (at most max_in_flight) are sent together, bootstrap calls
+        topped up with info calls, so that many connections are open afterwards. The bootstrap results
+        are kept in bootstrapped by method name, a PermissionIndex also in permissions. Returns a dict
+        with the bootstrap results, their latencies and errors (which are not raised), the warm-up
+        duration and time_to_ready, the seconds since the client was created."""
+        started = time.monotonic()
+        calls = [call if isinstance(call, tuple) else (call, {}) for call in bootstrap]
+        calls += [('info', {})] * (min(connections, self.max_in_flight) - len(calls))
+
+        async def timed(name, kwargs):
+            call_started = time.monotonic()
+            return await getattr(self, name)(**kwargs), time.monotonic() - call_started
+
+        outcomes = await asyncio.gather(*[timed(name, kwargs) for name, kwargs in calls], return_exceptions=True)
+        report = {'connections': len(calls), 'results': {}, 'latency': {}, 'errors': {}}
+        for (name, _), outcome in zip(calls[:len(bootstrap)], outcomes):
+            if isinstance(outcome, Exception):
+                report['errors'][name] = outcome
+            else:
+                report['results'][name], report['latency'][name] = outcome
+        self.bootstrapped.update(report['results'])
+        if isinstance(report['results'].get('permissions_index'), PermissionIndex):
+            self.permissions = report['results']['permissions_index']
+        report['warmup'] = time.monotonic() - started
+        report['time_to_ready'] = time.monotonic() - self._created_at
+        return report
 
     # Authentication
 
@@ -105,9 +468,10 @@ class RocketChat:
                                       data={'username': user,
                                             'password': password},
                                       verify=self.ssl_verify,
-                                      proxies=self.proxies)
+                                      proxies=self.proxies,
+                                      timeout=self.__timeout().as_requests())
         if login_request.status_code == 401:
-            print('login_request', login_request.text)
+            logger.warning('login failed: %s', login_request.text)
             raise RocketAuthenticationException()
 
         if login_request.status_code == 200:
@@ -137,7 +501,7 @@ class RocketChat:
     async def directory(self, query, **kwargs):
         """Search by users or channels on all server."""
         if isinstance(query, dict):
-            query = str(query).replace("'", '"')
+            query = json.dumps(query)
 
         return await self.__call_api_get('directory', query=query, kwargs=kwargs)
 
@@ -177,6 +541,40 @@ class RocketChat:
         else:
             raise RocketMissingParamException('userID or username required')
 
+    async def users_presence(self, from_date=None, ids=None, **kwargs):
+        """Gets the presence of all users not offline, or of the ones changed since from_date."""
+        if from_date:
+            kwargs['from'] = from_date
+        if ids:
+            kwargs['ids'] = ','.join(ids)
+        return await self.__call_api_get('users.presence', kwargs=kwargs)
+
+    async def users_presence_snapshot(self, table=None, user_ids=None):
+        """Refreshes a PresenceTable (a new one for user_ids if none is given) and returns it.
+
+        Uses a single users.presence call, fetching only changes since the previous refresh. Servers
+        without users.presence get concurrent users_get_presence calls for the table's user_ids."""
+        table = table if table is not None else PresenceTable(user_ids)
+        if table.bulk_supported is not False:
+            cursor = table.next_cursor()
+            with raw_responses():
+                response = await self.users_presence(from_date=table.cursor)
+            if response.status == 200:
+                table.bulk_supported = True
+                table.apply(response.json(), cursor)
+                return table
+            if response.status != 404:
+                raise RocketConnectionException(response.body)
+            table.bulk_supported = False
+        if table.user_ids is None:
+            raise RocketMissingParamException('user_ids required on servers without users.presence')
+        with decoded_responses():
+            arg_sets = [{'user_id': user_id} for user_id in table.user_ids]
+            async for result in self.amap('users_get_presence', arg_sets):
+                if result.exception is None and result.result.get('success'):
+                    table.set(result.arg_set['user_id'], result.result.get('presence', OFFLINE))
+        return table
+
     async def users_create(self, email, name, password, username, **kwargs):
         """Creates a user"""
         return await self.__call_api_post('users.create', email=email, name=name, password=password, username=username,
@@ -205,8 +603,9 @@ class RocketChat:
         if avatar_url.startswith('http://') or avatar_url.startswith('https://'):
             return await self.__call_api_post('users.setAvatar', avatarUrl=avatar_url, kwargs=kwargs)
         else:
-            avatar_file = {"image": open(avatar_url, "rb")}
-            return await self.__call_api_post('users.setAvatar', files=avatar_file, kwargs=kwargs)
+            with self.__open_file(avatar_url) as avatar:
+                avatar_file = {"image": avatar}
+                return await self.__call_api_post('users.setAvatar', files=avatar_file, kwargs=kwargs)
 
     async def users_reset_avatar(self, user_id=None, username=None, **kwargs):
         """Reset a user’s avatar"""
@@ -360,6 +759,12 @@ class RocketChat:
         """Removes a user from the channel."""
         return await self.__call_api_post('channels.kick', roomId=room_id, userId=user_id, kwargs=kwargs)
 
+    async def channels_join(self, room_id, join_code=None, **kwargs):
+        """Joins yourself to the channel, join_code is needed if the channel has one."""
+        if join_code:
+            return await self.__call_api_post('channels.join', roomId=room_id, joinCode=join_code, kwargs=kwargs)
+        return await self.__call_api_post('channels.join', roomId=room_id, kwargs=kwargs)
+
     async def channels_leave(self, room_id, **kwargs):
         """Causes the callee to be removed from the channel."""
         return await self.__call_api_post('channels.leave', roomId=room_id, kwargs=kwargs)
@@ -641,19 +1046,60 @@ class RocketChat:
         """Updates the setting for the provided _id."""
         return await self.__call_api_post('settings/' + _id, value=value)
 
-    async def settings(self):
+    async def settings(self, **kwargs):
         """List all private settings."""
-        return await self.__call_api_get('settings')
+        return await self.__call_api_get('settings', kwargs=kwargs)
+
+    async def settings_snapshot(self, page_size=100):
+        """Pulls all private settings into a SettingsSnapshot.
+
+        The first page tells how many settings there are, the remaining pages are fetched concurrently."""
+        with decoded_responses():
+            first = await self.settings(count=page_size, offset=0)
+            if not first.get('success'):
+                raise RocketConnectionException(first)
+            snapshot = SettingsSnapshot(first.get('settings', []))
+            pages = [{'count': page_size, 'offset': offset}
+                     for offset in range(page_size, first.get('total', 0), page_size)]
+            async for result in self.amap('settings', pages, fail_fast=True):
+                if not result.result.get('success'):
+                    raise RocketConnectionException(result.result)
+                snapshot.extend(result.result.get('settings', []))
+        return snapshot
+
+    async def settings_apply(self, desired, snapshot=None, concurrency=None, rate=None):
+        """Brings the server's settings to desired, a dict of _id to value.
+
+        Only settings whose value differs from snapshot (pulled with settings_snapshot if not given)
+        are updated, with at most concurrency updates in flight and, if rate is given, at most rate
+        updates started a second. Returns a FanOutResult per update in the order they finished, with
+        (_id, value) as arg_set; the snapshot is updated for every successful one."""
+        snapshot = snapshot if snapshot is not None else await self.settings_snapshot()
+        changes = snapshot.diff(desired).items()
+        if rate:
+            changes = apaced(changes, rate)
+
+        async def update(_id, value):
+            with decoded_responses():
+                return await self.settings_update(_id, value)
+
+        results = []
+        async for result in self.as_completed(update, changes, concurrency=concurrency):
+            if result.exception is None and result.result.get('success'):
+                snapshot.set(*result.arg_set)
+            results.append(result)
+        return results
 
     # Rooms
 
     async def rooms_upload(self, rid, file, **kwargs):
         """Post a message with attached file to a dedicated room."""
         mime_type = MIME.from_file(file)
-        files = {
-            'file': (file, open(file, 'rb'), mime_type, {})
-        }
-        return await self.__call_api_post('rooms.upload/' + rid, kwargs=kwargs, use_json=False, files=files)
+        with self.__open_file(file) as upload:
+            files = {
+                'file': (file, upload, mime_type, {})
+            }
+            return await self.__call_api_post('rooms.upload/' + rid, kwargs=kwargs, use_json=False, files=files)
 
     async def rooms_get(self, **kwargs):
         """Get all opened rooms for this user."""
@@ -663,6 +1109,67 @@ class RocketChat:
         """Cleans up a room, removing messages from the provided time range."""
         return await self.__call_api_post('rooms.cleanHistory', roomId=room_id, latest=latest, oldest=oldest, kwargs=kwargs)
 
+    async def __sweep_room(self, room_id, oldest, latest, checkpoint, chunk_options):
+        sweep = RoomSweep(room_id, oldest, latest, checkpoint, **chunk_options)
+        while not sweep.finished:
+            chunk_oldest, chunk_latest = sweep.next_chunk()
+            start = time.monotonic()
+            try:
+                with decoded_responses():
+                    result = await self.rooms_clean_history(room_id, latest=chunk_latest, oldest=chunk_oldest,
+                                                            inclusive=True)
+            except asyncio.TimeoutError as e:
+                sweep.timed_out(e)
+                continue
+            if not result.get('success'):
+                raise RocketConnectionException('cleaning {} failed: {}'.format(room_id, result))
+            sweep.done(time.monotonic() - start, result.get('count', 0))
+        return sweep.removed
+
+    def rooms_clean_history_sweep(self, room_ids, oldest, latest, checkpoint=None, concurrency=None,
+                                  **chunk_options):
+        """Cleans the history of many rooms between oldest and latest (datetimes) in adaptive time chunks.
+
+        Rooms are swept concurrently, at most concurrency (default the client's limit) at a time,
+        each one chunk after another so no single call covers more than the server handles quickly.
+        With a RetentionCheckpoint a restarted sweep resumes where it stopped. chunk_options go to
+        RoomSweep. Yields a FanOutResult per room, as rooms finish, with the messages removed."""
+        async def sweep(room_id):
+            return await self.__sweep_room(room_id, oldest, latest, checkpoint, chunk_options)
+
+        return self.as_completed(sweep, room_ids, concurrency=concurrency)
+
+    async def rooms_stale(self, older_than):
+        """Rooms of rooms_get (channels and groups only) without activity since older_than, an aware datetime."""
+        with decoded_responses():
+            result = await self.rooms_get()
+        if not result.get('success'):
+            raise RocketConnectionException(result)
+        for room in result.get('update', []):
+            if is_stale(room, older_than):
+                yield room
+
+    async def rooms_lifecycle(self, action, rooms, concurrency=None, **kwargs):
+        """Applies a lifecycle action (archive, unarchive, delete or set_type) to many rooms concurrently.
+
+        rooms are room dicts, as from rooms_stale, or (room_id, type) tuples, in a regular or async
+        iterable; each one is handled by the channels_ or groups_ method matching its type and kwargs
+        are passed on (e.g. a_type for set_type). At most concurrency calls run at a time. Yields a
+        RoomOutcome per room as they finish."""
+        async def apply(room):
+            room_id, room_type = room_key(room)
+            with decoded_responses():
+                return await getattr(self, method_for(action, room_type))(room_id, **kwargs)
+
+        async def wrap(rooms):
+            async for room in self.__iterate(rooms):
+                yield (room,)
+
+        async for result in self.as_completed(apply, wrap(rooms), concurrency=concurrency):
+            room_id, room_type = room_key(result.arg_set[0])
+            success = result.result is not None and result.result.get('success', False)
+            yield RoomOutcome(room_id, room_type, action, success, result.result, result.exception)
+
     async def rooms_favorite(self, room_id=None, room_name=None, favorite=True):
         """Favorite or unfavorite room."""
         if room_id is not None:
@@ -695,15 +1202,69 @@ class RocketChat:
         """Mark messages as unread by roomId or from a message"""
         return await self.__call_api_post('subscriptions.unread', roomId=room_id, kwargs=kwargs)
 
+    async def rooms_history_since(self, room_id, room_type, oldest, count=100):
+        """All messages of a room newer than oldest, oldest first, fetched count at a time."""
+        method = getattr(self, HISTORY_METHODS[room_type])
+        messages = []
+        kwargs = {'oldest': oldest, 'count': count}
+        while True:
+            with decoded_responses():
+                result = await method(room_id, **kwargs)
+            if not result.get('success'):
+                raise RocketConnectionException(result)
+            page = result.get('messages', [])
+            messages.extend(page)
+            if len(page) < count:
+                break
+            # Pages go from the newest message backwards
+            kwargs['latest'] = page[-1]['ts']
+        messages.reverse()
+        return messages
+
+    async def rooms_watch(self, rooms=None, watcher=None, count=100, concurrency=None):
+        """Polls rooms for new messages and yields them, oldest first per room, until closed.
+
+        rooms are room dicts or (room_id, type) tuples, by default every room the user is subscribed
+        to (kept up to date as subscriptions change). Each cycle makes one subscriptions_get call with
+        updatedSince to find the rooms with activity and only polls those, at most concurrency at a
+        time, plus idle rooms whose safety poll is due. watcher is a RoomWatcher holding intervals,
+        cursors and metrics, a new one if none is given. When subscriptions can't be read rooms are
+        polled on their own adaptive schedule."""
+        watcher = watcher if watcher is not None else RoomWatcher()
+        for room in rooms or ():
+            watcher.add(*room_key(room), now=time.monotonic())
+
+        async def poll(room_id):
+            return await self.rooms_history_since(room_id, watcher.rooms[room_id]['type'], watcher.cursor(room_id),
+                                                  count=count)
+
+        while True:
+            kwargs = {'updatedSince': watcher.subscriptions_cursor} if watcher.subscriptions_cursor else {}
+            with decoded_responses():
+                result = await self.subscriptions_get(**kwargs)
+            changed = None
+            if result.get('success'):
+                changed = watcher.apply_subscriptions(result, watch_new=rooms is None, now=time.monotonic())
+            selected = watcher.select(time.monotonic(), changed)
+            async for polled in self.as_completed(poll, selected, concurrency=concurrency):
+                if polled.exception is not None:
+                    watcher.failed(polled.arg_set, time.monotonic())
+                    continue
+                watcher.polled(polled.arg_set, polled.result, time.monotonic())
+                for message in polled.result:
+                    yield message
+            await asyncio.sleep(watcher.sleep_time(time.monotonic(), changed))
+
     # Assets
 
     async def assets_set_asset(self, asset_name, file, **kwargs):
         """Set an asset image by name."""
         content_type = mimetypes.MimeTypes().guess_type(file)
-        files = {
-            asset_name: (file, open(file, 'rb'), content_type[0], {'Expires': '0'}),
-        }
-        return await self.__call_api_post('assets.setAsset', kwargs=kwargs, use_json=False, files=files)
+        with self.__open_file(file) as asset:
+            files = {
+                asset_name: (file, asset, content_type[0], {'Expires': '0'}),
+            }
+            return await self.__call_api_post('assets.setAsset', kwargs=kwargs, use_json=False, files=files)
 
     async def assets_unset_asset(self, asset_name):
         """Unset an asset by name"""
@@ -712,10 +1273,23 @@ class RocketChat:
 
     # Permissions
 
-    async def permissions_list(self):
-        """Lists permissions on the server."""
-        return await self.__call_api_post('permissions.listAll')
+    async def permissions_list(self, **kwargs):
+        """Lists permissions on the server, only the ones changed since updatedSince if given."""
+        return await self.__call_api_get('permissions.listAll', kwargs=kwargs)
 
     async def permissions_update(self, permissions):
         """Edits permissions on the server."""
         return await self.__call_api_post('permissions.update', permissions=permissions)
+
+    async def permissions_index(self, index=None):
+        """Refreshes a PermissionIndex (a new one if none is given) and returns it.
+
+        After the first refresh only permissions changed since the previous one are fetched."""
+        index = index if index is not None else PermissionIndex()
+        kwargs = {'updatedSince': index.cursor} if index.cursor else {}
+        with decoded_responses():
+            result = await self.permissions_list(**kwargs)
+        if not result.get('success'):
+            raise RocketConnectionException(result)
+        index.apply(result)
+        return index
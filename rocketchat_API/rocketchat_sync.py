@@ -0,0 +1,116 @@
+# -*-coding:utf-8-*-
+import asyncio
+import inspect
+import threading
+
+from rocketchat_API import rocketchat_async
+from rocketchat_API.batch import Batch
+from rocketchat_API.fanout import iterate_futures
+
+
+class RocketChat:
+    """Thread-safe synchronous facade over rocketchat_async.RocketChat.
+
+    The async client lives on a dedicated event loop thread and every method of
+    rocketchat.RocketChat is available under the same name, blocking the calling thread until the
+    call finishes. Unlike rocketchat.RocketChat methods return the decoded JSON body. Methods that
+    yield their results (rooms_lifecycle, rooms_watch, as_completed, ...) return an iterator whose
+    every step blocks; leaving it early closes the generator on the loop. Calls from any number of
+    threads share the async client's connection pool and concurrency limits. Arguments are the
+    ones of rocketchat_async.RocketChat."""
+
+    def __init__(self, *args, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='rocketchat-loop', daemon=True)
+        self._thread.start()
+        self.client = self.__run_in_loop(self.__create_client, args, kwargs).result()
+
+    @staticmethod
+    async def __create_client(*args, **kwargs):
+        # The aiohttp session has to be created on the loop it is used from
+        return rocketchat_async.RocketChat(*args, **kwargs)
+
+    def __run_in_loop(self, func, args, kwargs):
+        if inspect.iscoroutinefunction(func):
+            coroutine = func(*args, **kwargs)
+        else:
+            coroutine = self.__call_in_loop(func, args, kwargs)
+        # The task is created in a copy of the calling thread's context, so deadlines and
+        # priorities set by the caller apply to the call
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    @staticmethod
+    async def __call_in_loop(func, args, kwargs):
+        return func(*args, **kwargs)
+
+    @staticmethod
+    async def __next_item(generator):
+        return await generator.__anext__()
+
+    def __iterate_in_loop(self, generator):
+        try:
+            while True:
+                try:
+                    item = self.__run_in_loop(self.__next_item, (generator,), {}).result()
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if self._thread.is_alive():
+                self.__run_in_loop(generator.aclose, (), {}).result()
+
+    def __getattr__(self, name):
+        if name == 'client':
+            raise AttributeError(name)
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            if inspect.isasyncgenfunction(attribute):
+                return self.__iterate_in_loop(attribute(*args, **kwargs))
+            result = self.__run_in_loop(attribute, args, kwargs).result()
+            if inspect.isasyncgen(result):
+                return self.__iterate_in_loop(result)
+            return result
+
+        call.__name__ = name
+        call.__doc__ = attribute.__doc__
+        return call
+
+    def submit(self, method, *args, **kwargs):
+        """Starts a client method (by name) on the event loop and returns a concurrent Future for it."""
+        return self.__run_in_loop(getattr(self.client, method), args, kwargs)
+
+    def map(self, method, arg_sets, ordered=True, max_in_flight=None):
+        """Runs a client method over many argument sets concurrently on the event loop.
+
+        Works like rocketchat.RocketChat.map: yields a FanOutResult per item, in input order or as
+        they complete, with at most max_in_flight (default the client's max_in_flight) calls pending."""
+        func = getattr(self.client, method)
+
+        def submit(args, kwargs):
+            return self.__run_in_loop(func, args, kwargs)
+
+        return iterate_futures(submit, arg_sets, ordered, max_in_flight or self.client.max_in_flight)
+
+    def batch(self):
+        """Context manager queueing the calls made through it and running them concurrently on exit,
+        see rocketchat.RocketChat.batch."""
+        return Batch(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self, timeout=None):
+        """Closes the async client, waiting up to timeout seconds for calls in flight, and stops the
+        event loop thread."""
+        if not self._thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self.client.close(timeout), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
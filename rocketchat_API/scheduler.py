@@ -0,0 +1,108 @@
+# -*-coding:utf-8-*-
+import asyncio
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+
+INTERACTIVE = 'interactive'
+DEFAULT = 'default'
+BULK = 'bulk'
+
+_priority = contextvars.ContextVar('rocketchat_API_priority', default=DEFAULT)
+
+
+@contextmanager
+def priority(name):
+    """Calls made inside the block, including tasks started from it, are queued in class name."""
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class PriorityScheduler:
+    """Hands out the async client's request slots by priority class.
+
+    classes are ordered from highest to lowest priority and a free slot goes to the highest class
+    with waiting calls, except that a class listed in min_share is served first whenever its share
+    of recent grants has fallen below that fraction, so bulk work keeps moving under interactive
+    load. Calls outside of a priority() block use DEFAULT."""
+
+    def __init__(self, slots=10, classes=(INTERACTIVE, DEFAULT, BULK), min_share=None, decay=0.99):
+        self.slots = slots
+        self.classes = tuple(classes)
+        self.min_share = {BULK: 0.1} if min_share is None else min_share
+        self.decay = decay
+        self.in_use = 0
+        self._queues = {name: deque() for name in self.classes}
+        self._recent = {name: 0.0 for name in self.classes}
+        self._stats = {name: {'granted': 0, 'wait_total': 0.0, 'wait_max': 0.0} for name in self.classes}
+
+    def __class_of(self, name):
+        if name not in self._queues:
+            raise ValueError('unknown priority class {}'.format(name))
+        return name
+
+    def __pick(self):
+        waiting = [name for name in self.classes if self._queues[name]]
+        total = sum(self._recent.values())
+        for name in waiting:
+            share = self.min_share.get(name)
+            if share and self._recent[name] < share * total:
+                return name
+        return waiting[0]
+
+    def __grant(self, name, waited):
+        self.in_use += 1
+        for other in self._recent:
+            self._recent[other] *= self.decay
+        self._recent[name] += 1
+        stats = self._stats[name]
+        stats['granted'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+
+    def __dispatch(self):
+        while self.in_use < self.slots and any(self._queues.values()):
+            name = self.__pick()
+            waiter, enqueued = self._queues[name].popleft()
+            if not waiter.done():
+                self.__grant(name, time.monotonic() - enqueued)
+                waiter.set_result(None)
+
+    async def acquire(self, name=None):
+        name = self.__class_of(name or _priority.get())
+        if self.in_use < self.slots and not any(self._queues.values()):
+            self.__grant(name, 0.0)
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        entry = (waiter, time.monotonic())
+        self._queues[name].append(entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just before the cancellation, hand it on
+                self.release()
+            elif entry in self._queues[name]:
+                self._queues[name].remove(entry)
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self.__dispatch()
+
+    def metrics(self):
+        """Slots in use plus, per class, calls waiting, calls granted and queue wait times in seconds."""
+        classes = {}
+        for name in self.classes:
+            stats = self._stats[name]
+            classes[name] = {
+                'waiting': len(self._queues[name]),
+                'granted': stats['granted'],
+                'wait_avg': stats['wait_total'] / stats['granted'] if stats['granted'] else 0.0,
+                'wait_max': stats['wait_max'],
+            }
+        return {'slots': self.slots, 'in_use': self.in_use, 'classes': classes}
@@ -0,0 +1,41 @@
+# -*-coding:utf-8-*-
+
+
+class SettingsSnapshot:
+    """Settings of a server indexed by _id, as pulled by settings_snapshot."""
+
+    def __init__(self, settings=()):
+        self.settings = {}
+        self.extend(settings)
+
+    def extend(self, settings):
+        """Adds settings as returned by the settings endpoint (dicts with _id and value)."""
+        for setting in settings:
+            self.settings[setting['_id']] = setting
+
+    def __contains__(self, _id):
+        return _id in self.settings
+
+    def __len__(self):
+        return len(self.settings)
+
+    def __getitem__(self, _id):
+        return self.settings[_id]['value']
+
+    def get(self, _id, default=None):
+        setting = self.settings.get(_id)
+        return setting.get('value', default) if setting is not None else default
+
+    def set(self, _id, value):
+        self.settings.setdefault(_id, {'_id': _id})['value'] = value
+
+    def values(self):
+        """The snapshot as a dict of _id to value."""
+        return {_id: setting.get('value') for _id, setting in self.settings.items()}
+
+    def diff(self, desired):
+        """The entries of desired (a dict of _id to value) that differ from the snapshot.
+
+        Settings missing from the snapshot are included, so the server reports them."""
+        return {_id: value for _id, value in desired.items()
+                if _id not in self.settings or self.settings[_id].get('value') != value}
@@ -0,0 +1,192 @@
+# -*-coding:utf-8-*-
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from rocketchat_API.APIExceptions.RocketExceptions import RocketSpoolFullException
+
+logger = logging.getLogger(__name__)
+
+REJECT = 'reject'
+DROP_OLDEST = 'drop_oldest'
+
+
+class MessageSpool:
+    """Durable outbound queue in front of chat_post_message and rooms_upload of the sync client.
+
+    Sends are written to a SQLite file and return immediately; start() drains them with up to
+    concurrency rooms in flight and one message at a time per room, so each room keeps its order.
+    Throttling (429), server errors, connection errors and timeouts are retried with exponential
+    backoff; other failures, e.g. an upload whose file is gone, are dropped and counted. Anything
+    not yet delivered is picked up again by the next spool opened on the same file. Once max_size
+    messages are waiting, overflow decides between raising RocketSpoolFullException (REJECT) and
+    discarding the oldest message not being delivered (DROP_OLDEST). Uploads are spooled by path,
+    so the file has to exist until it is sent."""
+
+    def __init__(self, rocket, path, max_size=10000, overflow=REJECT, concurrency=4,
+                 retry_delay=1.0, max_retry_delay=60.0):
+        if overflow not in (REJECT, DROP_OLDEST):
+            raise ValueError('overflow must be {} or {}'.format(REJECT, DROP_OLDEST))
+        self.rocket = rocket
+        self.max_size = max_size
+        self.overflow = overflow
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'room TEXT NOT NULL, method TEXT NOT NULL, payload TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0)')
+        self._condition = threading.Condition()
+        # Room -> spool id of the message being delivered to it
+        self._busy_rooms = {}
+        self._retry_at = {}
+        self._deliveries = deque(maxlen=1000)
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+
+    def __enqueue(self, room, method, payload):
+        with self._condition:
+            if self.backlog() >= self.max_size:
+                if self.overflow == REJECT:
+                    raise RocketSpoolFullException('spool holds {} messages'.format(self.max_size))
+                in_flight = list(self._busy_rooms.values())
+                oldest = self._db.execute('SELECT MIN(id) FROM spool WHERE id NOT IN ({})'.format(
+                    ', '.join('?' * len(in_flight))), in_flight).fetchone()[0]
+                if oldest is None:
+                    raise RocketSpoolFullException('spool holds {} messages, all in flight'.format(self.max_size))
+                self._db.execute('DELETE FROM spool WHERE id = ?', (oldest,))
+                self.dropped += 1
+            cursor = self._db.execute('INSERT INTO spool (room, method, payload) VALUES (?, ?, ?)',
+                                      (room, method, json.dumps(payload)))
+            self._condition.notify_all()
+            return cursor.lastrowid
+
+    def post_message(self, text=None, room_id=None, channel=None, **kwargs):
+        """Spools a chat_post_message call and returns its spool id."""
+        payload = dict(kwargs, text=text, room_id=room_id, channel=channel)
+        return self.__enqueue(room_id or channel, 'chat_post_message', payload)
+
+    def upload(self, rid, file, **kwargs):
+        """Spools a rooms_upload call and returns its spool id."""
+        return self.__enqueue(rid, 'rooms_upload', dict(kwargs, rid=rid, file=file))
+
+    def backlog(self):
+        """Messages waiting to be delivered, including the ones in flight."""
+        with self._condition:
+            return self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+    def drain_rate(self, window=60.0):
+        """Messages delivered per second over the last window seconds."""
+        since = time.monotonic() - window
+        with self._condition:
+            return len([delivered for delivered in self._deliveries if delivered >= since]) / window
+
+    def metrics(self):
+        return {
+            'backlog': self.backlog(),
+            'in_flight': len(self._busy_rooms),
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'drain_rate': self.drain_rate(),
+        }
+
+    def start(self):
+        """Starts draining the spool in background threads."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            self._thread = threading.Thread(target=self.__dispatch, name='rocketchat-spool', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops draining once the messages in flight are done, the rest stays spooled."""
+        with self._condition:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._thread = None
+        self._executor = None
+
+    def flush(self, timeout=None):
+        """Waits until the spool is empty, returns False if timeout expired first."""
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.backlog():
+                left = None if expires is None else expires - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._condition.wait(left)
+        return True
+
+    def close(self):
+        self.stop()
+        self._db.close()
+
+    def __ready(self, now):
+        rows = self._db.execute('SELECT id, room, method, payload, attempts FROM spool '
+                                'WHERE id IN (SELECT MIN(id) FROM spool GROUP BY room) ORDER BY id').fetchall()
+        return [row for row in rows
+                if row[1] not in self._busy_rooms and self._retry_at.get(row[1], 0) <= now]
+
+    def __dispatch(self):
+        with self._condition:
+            while not self._stopping:
+                now = time.monotonic()
+                free = self.concurrency - len(self._busy_rooms)
+                rows = self.__ready(now)[:free] if free > 0 else []
+                for row in rows:
+                    self._busy_rooms[row[1]] = row[0]
+                    self._executor.submit(self.__deliver, *row)
+                if not rows:
+                    # Sleep until something is spooled, a delivery ends or the next retry is due
+                    waits = [retry_at - now for retry_at in self._retry_at.values() if retry_at > now]
+                    self._condition.wait(min(waits) if waits else None)
+            while self._busy_rooms:
+                self._condition.wait()
+
+    def __deliver(self, spool_id, room, method, payload, attempts):
+        status = None
+        error = None
+        try:
+            response = getattr(self.rocket, method)(**json.loads(payload))
+            status = response.status_code
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logger.warning('spooled %s to %s failed, retrying: %s', method, room, e)
+        except Exception as e:
+            # Retrying can't help, and would hold up the room's later messages forever
+            error = e
+        with self._condition:
+            if status == 200:
+                self._db.execute('DELETE FROM spool WHERE id = ?', (spool_id,))
+                self._retry_at.pop(room, None)
+                self.sent += 1
+                self._deliveries.append(time.monotonic())
+            elif error is None and (status is None or status == 429 or status >= 500):
+                self._db.execute('UPDATE spool SET attempts = ? WHERE id = ?', (attempts + 1, spool_id))
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempts)
+                self._retry_at[room] = time.monotonic() + delay
+            else:
+                logger.warning('dropping spooled %s to %s, %s', method, room,
+                               'server answered {}'.format(status) if error is None else error)
+                self._db.execute('DELETE FROM spool WHERE id = ?', (spool_id,))
+                self._retry_at.pop(room, None)
+                self.failed += 1
+            self._busy_rooms.pop(room, None)
+            self._condition.notify_all()
@@ -0,0 +1,140 @@
+# -*-coding:utf-8-*-
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def flatten(stats, prefix=''):
+    """Numeric values of a (nested) statistics dict keyed by dotted path."""
+    values = {}
+    for key, value in stats.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            values.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+class StatisticsCollector:
+    """Serves the server statistics of the sync client from a snapshot refreshed in the background.
+
+    start() fetches statistics (and statistics_list with list_kwargs, if given) every interval
+    seconds on a daemon thread. snapshot(), delta() and metrics() only read the last results, so
+    readers never make the server compute statistics. A failed refresh keeps the previous snapshot.
+    With force_refresh the server recomputes its statistics on every refresh instead of returning
+    the ones it cached itself."""
+
+    def __init__(self, rocket, interval=300.0, list_kwargs=None, force_refresh=False):
+        self.rocket = rocket
+        self.interval = interval
+        self.list_kwargs = list_kwargs
+        self.force_refresh = force_refresh
+        self.refreshes = 0
+        self.failures = 0
+        self.refreshed_at = None
+        self.statistics_list = None
+        self._condition = threading.Condition()
+        self._current = None
+        self._previous = None
+        self._thread = None
+        self._stopping = False
+
+    def refresh(self):
+        """Fetches new statistics right away, returns True if the snapshot was replaced."""
+        try:
+            kwargs = {'refresh': 'true'} if self.force_refresh else {}
+            response = self.rocket.statistics(**kwargs)
+            stats_list = None
+            if response.status_code == 200 and self.list_kwargs is not None:
+                list_response = self.rocket.statistics_list(**self.list_kwargs)
+                if list_response.status_code != 200:
+                    response = list_response
+                else:
+                    stats_list = list_response.json().get('statistics')
+        except Exception as e:
+            logger.warning('refreshing statistics failed: %s', e)
+            response = None
+        with self._condition:
+            if response is None or response.status_code != 200:
+                if response is not None:
+                    logger.warning('refreshing statistics failed, server answered %s', response.status_code)
+                self.failures += 1
+                return False
+            stats = response.json()
+            stats.pop('success', None)
+            self._previous = self._current
+            self._current = (time.time(), stats)
+            if stats_list is not None:
+                self.statistics_list = stats_list
+            self.refreshes += 1
+            self.refreshed_at = self._current[0]
+            self._condition.notify_all()
+            return True
+
+    def start(self):
+        """Refreshes now and then every interval seconds in a background thread."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self.__run, name='rocketchat-statistics', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def __run(self):
+        while True:
+            self.refresh()
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping, self.interval)
+                if self._stopping:
+                    return
+
+    def wait(self, timeout=None):
+        """Waits for the first snapshot, returns False if timeout expired first."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._current is not None, timeout)
+
+    def snapshot(self):
+        """Last statistics fetched, None before the first refresh."""
+        with self._condition:
+            return self._current[1] if self._current is not None else None
+
+    def age(self):
+        """Seconds since the snapshot was fetched, None before the first refresh."""
+        with self._condition:
+            return time.time() - self._current[0] if self._current is not None else None
+
+    def delta(self):
+        """Changes of the numeric statistics between the last two snapshots, keyed by dotted path,
+        plus 'elapsed' seconds between them. Empty until two snapshots were fetched."""
+        with self._condition:
+            if self._previous is None:
+                return {}
+            (previous_at, previous), (current_at, current) = self._previous, self._current
+        before = flatten(previous)
+        changes = {name: value - before[name] for name, value in flatten(current).items() if name in before}
+        changes['elapsed'] = current_at - previous_at
+        return changes
+
+    def metrics(self):
+        """Numeric statistics of the snapshot, their deltas under 'delta.' and the collector's own counters."""
+        snapshot = self.snapshot()
+        values = flatten(snapshot) if snapshot is not None else {}
+        values.update(('delta.' + name, value) for name, value in self.delta().items())
+        values.update({
+            'collector.refreshes': self.refreshes,
+            'collector.failures': self.failures,
+            'collector.age': self.age(),
+        })
+        return values
@@ -0,0 +1,84 @@
+# -*-coding:utf-8-*-
+import contextvars
+import time
+from contextlib import contextmanager
+
+from rocketchat_API.APIExceptions.RocketExceptions import RocketDeadlineException
+
+_deadline = contextvars.ContextVar('rocketchat_API_deadline', default=None)
+_override = contextvars.ContextVar('rocketchat_API_timeout', default=None)
+
+
+class Timeout:
+    """Split timeouts in seconds, None meaning no limit.
+
+    connect bounds establishing the connection, read bounds waiting for the server between
+    bytes and total bounds the whole call. The synchronous client can't bound a whole call,
+    so there total caps connect and read instead."""
+
+    def __init__(self, connect=None, read=None, total=None):
+        self.connect = connect
+        self.read = read
+        self.total = total
+
+    def __repr__(self):
+        return 'Timeout(connect={}, read={}, total={})'.format(self.connect, self.read, self.total)
+
+    def clamp(self, seconds):
+        """Returns a copy where no timeout exceeds seconds."""
+        return Timeout(*[seconds if value is None else min(value, seconds)
+                         for value in (self.connect, self.read, self.total)])
+
+    def as_requests(self):
+        """(connect, read) tuple as requests expects it."""
+        if self.total is None:
+            return self.connect, self.read
+        return tuple(self.total if value is None else min(value, self.total)
+                     for value in (self.connect, self.read))
+
+
+def remaining():
+    """Seconds left in the current deadline, None outside of one."""
+    expires = _deadline.get()
+    if expires is None:
+        return None
+    return expires - time.monotonic()
+
+
+@contextmanager
+def deadline(seconds):
+    """Every call made inside the block, including nested deadlines, shares a budget of seconds.
+
+    Calls started once the budget is gone raise RocketDeadlineException without hitting the
+    server and calls in flight get at most the remaining time. The deadline follows asyncio
+    tasks created inside the block and calls fanned out with map() or submit()."""
+    expires = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        expires = min(expires, current)
+    token = _deadline.set(expires)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def override(connect=None, read=None, total=None):
+    """Calls made inside the block use these timeouts instead of the client's."""
+    token = _override.set(Timeout(connect, read, total))
+    try:
+        yield
+    finally:
+        _override.reset(token)
+
+
+def effective_timeout(default):
+    """Timeout for the next call: the active override or default, bounded by the active deadline."""
+    timeout = _override.get() or default
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise RocketDeadlineException('deadline exceeded')
+    return timeout.clamp(left)
@@ -0,0 +1,138 @@
+# -*-coding:utf-8-*-
+import datetime
+import random
+
+from rocketchat_API.retention import to_iso
+
+# History method per room type: c public channel, p private group, d direct message
+HISTORY_METHODS = {'c': 'channels_history', 'p': 'groups_history', 'd': 'im_history'}
+
+
+class RoomWatcher:
+    """Cursors and polling schedule of the rooms followed by rooms_watch of either client.
+
+    Each room is polled for messages newer than the last one seen, starting at since (default: now).
+    A poll that finds messages resets the room's interval to min_interval, an empty one doubles it
+    up to max_interval. Once subscriptions report which rooms changed, rooms that didn't are only
+    polled when their safety poll is due or when their previous poll failed. Safety polls are due
+    max_interval after the last poll, brought forward by a random share (up to jitter) of it, and
+    first polls are put off by up to jitter of min_interval, so that rooms watched together aren't
+    all polled in the same cycle."""
+
+    def __init__(self, min_interval=2.0, max_interval=300.0, since=None, jitter=0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.since = since
+        self.jitter = jitter
+        self.subscriptions_cursor = None
+        self.rooms = {}
+        self.polls = 0
+        self.messages = 0
+        self.errors = 0
+
+    def add(self, room_id, room_type, now=0.0):
+        """Starts watching a room, rooms of types without a history method are ignored."""
+        if room_id in self.rooms or room_type not in HISTORY_METHODS:
+            return
+        self.rooms[room_id] = {
+            'type': room_type,
+            'cursor': to_iso(self.since or datetime.datetime.now(datetime.timezone.utc)),
+            'interval': self.min_interval,
+            'next_poll': now + self.min_interval * self.jitter * random.random(),
+            'last_poll': now,
+            'safety_poll': self.__safety_poll(now),
+            'retry': False,
+            'hot': False,
+        }
+
+    def __safety_poll(self, now):
+        return now + self.max_interval * (1 - self.jitter * random.random())
+
+    def remove(self, room_id):
+        self.rooms.pop(room_id, None)
+
+    def history_method(self, room_id):
+        return HISTORY_METHODS[self.rooms[room_id]['type']]
+
+    def cursor(self, room_id):
+        return self.rooms[room_id]['cursor']
+
+    def apply_subscriptions(self, payload, watch_new=False, now=0.0):
+        """Applies a subscriptions_get answer and returns the ids of the rooms whose subscription
+        changed since the previous one. With watch_new rooms subscribed to are watched and rooms
+        unsubscribed from dropped. The first answer has no previous one to compare with: it reports
+        every room as changed when since was given, so they catch up, and none otherwise."""
+        first = self.subscriptions_cursor is None
+        changed = set()
+        for subscription in payload.get('update', []):
+            room_id = subscription.get('rid')
+            if watch_new:
+                self.add(room_id, subscription.get('t'), now)
+            changed.add(room_id)
+            self.__advance(subscription)
+        for subscription in payload.get('remove', []):
+            if watch_new:
+                self.remove(subscription.get('rid'))
+            self.__advance(subscription)
+        if first:
+            changed = set(self.rooms) if self.since is not None else set()
+        return changed & set(self.rooms)
+
+    def __advance(self, subscription):
+        updated_at = subscription.get('_updatedAt')
+        if not isinstance(updated_at, str):
+            return
+        if self.subscriptions_cursor is None or updated_at > self.subscriptions_cursor:
+            self.subscriptions_cursor = updated_at
+
+    def select(self, now, changed=None):
+        """Ids of the rooms to poll now. changed is the set of rooms with activity or None if unknown."""
+        if changed is None:
+            return [room_id for room_id, room in self.rooms.items() if room['next_poll'] <= now]
+        return [room_id for room_id, room in self.rooms.items()
+                if room_id in changed or (room['retry'] and room['next_poll'] <= now)
+                or room['safety_poll'] <= now]
+
+    def polled(self, room_id, messages, now):
+        """Records a poll of a room and the messages it found, oldest first."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        self.polls += 1
+        self.messages += len(messages)
+        if messages:
+            room['cursor'] = max(room['cursor'], messages[-1]['ts'])
+            room['interval'] = self.min_interval
+        else:
+            room['interval'] = min(self.max_interval, room['interval'] * 2)
+        room['hot'] = bool(messages)
+        room['last_poll'] = now
+        room['next_poll'] = now + room['interval']
+        room['safety_poll'] = self.__safety_poll(now)
+        room['retry'] = False
+
+    def failed(self, room_id, now):
+        """Records a failed poll, the room is polled again after its interval whatever subscriptions say."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        self.errors += 1
+        room['next_poll'] = now + room['interval']
+        room['retry'] = True
+
+    def sleep_time(self, now, changed=None):
+        """Seconds until the next cycle, at most min_interval. With changed (see select) every cycle
+        lasts min_interval, since rooms are then polled on activity rather than on schedule."""
+        if changed is not None:
+            return self.min_interval
+        next_poll = min((room['next_poll'] for room in self.rooms.values()), default=now + self.min_interval)
+        return max(0.0, min(self.min_interval, next_poll - now))
+
+    def metrics(self):
+        return {
+            'rooms': len(self.rooms),
+            'hot': len([room for room in self.rooms.values() if room['hot']]),
+            'polls': self.polls,
+            'messages': self.messages,
+            'errors': self.errors,
+        }
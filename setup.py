@@ -13,6 +13,7 @@ setup(
     description='Python API wrapper for Rocket.Chat',
     long_description=open("README.md", "r").read(),
     long_description_content_type="text/markdown",
+    python_requires='>=3.9',
     install_requires=(
         'requests',
     )
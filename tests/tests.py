@@ -1,8 +1,38 @@
+import asyncio
+import collections
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 
-from rocketchat_API.APIExceptions.RocketExceptions import RocketAuthenticationException, RocketMissingParamException
+import aiohttp.web
+import requests
+
+from rocketchat_API import request_log, rocketchat_async, rocketchat_sync, timeouts
+from rocketchat_API.APIExceptions.RocketExceptions import RocketAuthenticationException, RocketMissingParamException, \
+    RocketDeadlineException, RocketSpoolFullException, RocketClientClosedException
+from rocketchat_API.batch import AsyncBatchFuture, BatchFuture, dependencies, resolve
+from rocketchat_API.coalescer import ATTACHMENTS, MessageCoalescer
+from rocketchat_API.hedging import HedgePolicy
+from rocketchat_API.lifecycle import is_stale, last_activity, method_for, room_key
+from rocketchat_API.limiter import AdaptiveLimiter
+from rocketchat_API.loadgen import LoadGenerator, LoadReport, Scenario, register_users
+from rocketchat_API.permissions import PermissionIndex
+from rocketchat_API.presence import PresenceTable
+from rocketchat_API.query import LEAN_USER, Query
+from rocketchat_API.realtime import NotifyFeed, RealtimeCache
+from rocketchat_API.retention import RetentionCheckpoint, RoomSweep
 from rocketchat_API.rocketchat import RocketChat
+from rocketchat_API.scheduler import BULK, DEFAULT, INTERACTIVE, PriorityScheduler
+from rocketchat_API.settings import SettingsSnapshot
+from rocketchat_API.spool import DROP_OLDEST, MessageSpool
+from rocketchat_API.statistics import StatisticsCollector, flatten
+from rocketchat_API.watcher import RoomWatcher
 
 
 class TestServer(unittest.TestCase):
@@ -20,6 +50,15 @@ class TestServer(unittest.TestCase):
         self.assertTrue('info' in info)
         self.assertTrue(info.get('success'))
 
+    def test_warmup(self):
+        report = self.rocket.warmup(connections=5, bootstrap=('me', 'info', 'permissions_index'))
+        self.assertEqual(report.get('errors'), {})
+        self.assertEqual(report.get('connections'), 5)
+        self.assertEqual(report.get('results').get('me').json().get('username'), self.user)
+        self.assertTrue(report.get('results').get('permissions_index').can('admin', 'access-permissions'))
+        self.assertIs(self.rocket.permissions, report.get('results').get('permissions_index'))
+        self.assertGreaterEqual(report.get('time_to_ready'), report.get('warmup'))
+
     def test_statistics(self):
         statistics = self.rocket.statistics().json()
         self.assertTrue(statistics.get('success'))
@@ -28,6 +67,17 @@ class TestServer(unittest.TestCase):
         statistics_list = self.rocket.statistics_list().json()
         self.assertTrue(statistics_list.get('success'))
 
+    def test_statistics_collector(self):
+        collector = StatisticsCollector(self.rocket, interval=0.5, list_kwargs={})
+        collector.start()
+        self.assertTrue(collector.wait(timeout=30))
+        self.assertIn('totalUsers', collector.snapshot())
+        self.assertIsNotNone(collector.statistics_list)
+        time.sleep(1.5)
+        collector.stop()
+        self.assertGreater(collector.refreshes, 1)
+        self.assertIn('delta.totalUsers', collector.metrics())
+
     def test_directory(self):
         directory = self.rocket.directory(
             query={'text': 'rocket', 'type': 'users'}).json()
@@ -105,6 +155,20 @@ class TestUsers(unittest.TestCase):
         with self.assertRaises(RocketMissingParamException):
             self.rocket.users_get_presence()
 
+    def test_users_presence(self):
+        users_presence = self.rocket.users_presence().json()
+        self.assertTrue(users_presence.get('success'))
+        self.assertIn('users', users_presence)
+
+    def test_users_presence_snapshot(self):
+        me = self.rocket.me().json()
+        table = self.rocket.users_presence_snapshot()
+        self.assertTrue(table.bulk_supported)
+        self.assertIsNotNone(table.cursor)
+        self.assertEqual(table.status(user_id=me.get('_id')), table.status(username=self.user))
+        table = self.rocket.users_presence_snapshot(table)
+        self.assertIsNotNone(table.cursor)
+
     def test_users_get_avatar(self):
         login = self.rocket.login(self.user, self.password).json()
 
@@ -196,6 +260,12 @@ class TestUsers(unittest.TestCase):
         users_get_preferences = self.rocket.users_get_preferences().json()
         self.assertTrue(users_get_preferences.get('success'))
 
+    def test_users_list_lean(self):
+        users_list = self.rocket.users_list(**LEAN_USER.where(username=self.user).params()).json()
+        self.assertTrue(users_list.get('success'))
+        self.assertEqual(len(users_list.get('users')), 1)
+        self.assertEqual(set(users_list.get('users')[0].keys()), {'_id', 'username'})
+
     def test_users_list(self):
         users_list = self.rocket.users_list().json()
         self.assertTrue(users_list.get('success'))
@@ -402,6 +472,10 @@ class TestChannels(unittest.TestCase):
             'GENERAL', self.testuser_id).json()
         self.assertTrue(channels_kick.get('success'))
 
+    def test_channels_join(self):
+        channels_join = self.rocket.channels_join('GENERAL').json()
+        self.assertTrue(channels_join.get('success'))
+
     def test_channels_leave(self):
         channels_leave = self.rocket.channels_leave('GENERAL').json()
         self.assertFalse(channels_leave.get('success'))
@@ -457,6 +531,23 @@ class TestChannels(unittest.TestCase):
         self.assertEqual(channels_set_topic.get('topic'), topic,
                          'Topic does not match')
 
+    def test_channels_batch(self):
+        with self.rocket.batch() as batch:
+            created = [batch.channels_create(str(uuid.uuid1())) for _ in range(3)]
+            topics = [batch.channels_set_topic(channel['channel']['_id'], 'batched') for channel in created]
+            missing = batch.channels_set_topic(created[0]['unknown'], 'batched')
+        for channels_set_topic in topics:
+            self.assertEqual(channels_set_topic.result().json().get('topic'), 'batched')
+        with self.assertRaises(RocketMissingParamException):
+            missing.result()
+
+    def test_channels_watch(self):
+        watcher = RoomWatcher(min_interval=0.5, since=datetime.datetime.now(datetime.timezone.utc))
+        watch = self.rocket.rooms_watch(rooms=[('GENERAL', 'c')], watcher=watcher)
+        message_id = self.rocket.chat_post_message('watched', room_id='GENERAL').json()['message']['_id']
+        self.assertEqual(next(watch)['_id'], message_id)
+        watch.close()
+
     def test_channels_set_type(self):
         name = str(uuid.uuid1())
         channels_create = self.rocket.channels_create(name).json()
@@ -793,6 +884,31 @@ class TestRooms(unittest.TestCase):
                                                               oldest='2016-05-30T13:42:25.304Z').json()
         self.assertTrue(rooms_clean_history.get('success'))
 
+    def test_rooms_clean_history_sweep(self):
+        results = list(self.rocket.rooms_clean_history_sweep(['GENERAL'], oldest=datetime.datetime(2016, 5, 30),
+                                                             latest=datetime.datetime(2016, 9, 30)))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].arg_set, 'GENERAL')
+        self.assertIsNone(results[0].exception)
+        self.assertEqual(results[0].result, 0)
+
+    def test_rooms_lifecycle(self):
+        name = str(uuid.uuid1())
+        room_id = self.rocket.groups_create(name).json().get('group').get('_id')
+        outcomes = list(self.rocket.rooms_lifecycle('archive', [(room_id, 'p'), ('GENERAL', 'd')]))
+        by_room = {outcome.room_id: outcome for outcome in outcomes}
+        self.assertTrue(by_room[room_id].success)
+        self.assertFalse(by_room['GENERAL'].success)
+        self.assertIsInstance(by_room['GENERAL'].error, ValueError)
+        outcomes = list(self.rocket.rooms_lifecycle('delete', [(room_id, 'p')]))
+        self.assertTrue(outcomes[0].success)
+
+    def test_rooms_stale(self):
+        future = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        self.assertIn('GENERAL', [room['_id'] for room in self.rocket.rooms_stale(future)])
+        past = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(list(self.rocket.rooms_stale(past)), [])
+
     def test_rooms_favorite(self):
         rooms_favorite = self.rocket.rooms_favorite(
             room_id='GENERAL', favorite=True).json()
@@ -945,6 +1061,15 @@ class TestSettings(unittest.TestCase):
             _id='API_Allow_Infinite_Count', value=True).json()
         self.assertTrue(settings_update.get('success'))
 
+    def test_settings_snapshot_and_apply(self):
+        snapshot = self.rocket.settings_snapshot(page_size=50)
+        self.assertGreater(len(snapshot), 50)
+        self.assertTrue(snapshot['API_Allow_Infinite_Count'])
+        results = self.rocket.settings_apply({'API_Allow_Infinite_Count': True, 'Site_Name': 'Apply test'}, snapshot)
+        self.assertEqual([result.arg_set for result in results], [('Site_Name', 'Apply test')])
+        self.assertEqual(results[0].result.status_code, 200)
+        self.assertEqual(snapshot['Site_Name'], 'Apply test')
+
 
 class TestSubscriptions(unittest.TestCase):
     def setUp(self):
@@ -998,5 +1123,1319 @@ class TestAssets(unittest.TestCase):
         self.assertTrue(assets_unset_asset.get('success'))
 
 
+class TestPermissions(unittest.TestCase):
+    def setUp(self):
+        self.rocket = RocketChat()
+        self.user = 'user1'
+        self.password = 'password'
+        self.email = 'email@domain.com'
+        self.rocket.users_register(
+            email=self.email, name=self.user, password=self.password, username=self.user)
+        self.rocket = RocketChat(self.user, self.password)
+
+    def test_permissions_list(self):
+        permissions_list = self.rocket.permissions_list().json()
+        self.assertTrue(permissions_list.get('success'))
+        self.assertTrue(permissions_list.get('update'))
+
+    def test_permissions_update(self):
+        permissions_update = self.rocket.permissions_update(
+            permissions=[{'_id': 'access-permissions', 'roles': ['admin', 'bot']}]).json()
+        self.assertTrue(permissions_update.get('success'))
+
+    def test_permissions_index(self):
+        index = self.rocket.permissions_index()
+        self.assertTrue(index.can('admin', 'access-permissions'))
+        self.assertIsNotNone(index.cursor)
+        self.rocket.permissions_update(permissions=[{'_id': 'access-permissions', 'roles': ['admin', 'bot']}])
+        self.rocket.permissions_index(index)
+        self.assertTrue(index.can('bot', 'access-permissions'))
+
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.rocket = RocketChat()
+        self.user = 'user1'
+        self.password = 'password'
+        self.email = 'email@domain.com'
+        self.rocket.users_register(
+            email=self.email, name=self.user, password=self.password, username=self.user)
+        self.rocket = RocketChat(self.user, self.password, max_workers=4)
+
+    def test_submit(self):
+        future = self.rocket.submit('users_info', username=self.user)
+        self.assertTrue(future.result().json().get('success'))
+
+    def test_map_ordered(self):
+        arg_sets = [{'username': self.user}] * 10
+        results = list(self.rocket.map('users_info', arg_sets, max_in_flight=3))
+        self.assertEqual([result.index for result in results], list(range(10)))
+        for result in results:
+            self.assertIsNone(result.exception)
+            self.assertTrue(result.result.json().get('success'))
+
+    def test_map_as_completed_captures_errors(self):
+        arg_sets = [{'username': self.user}, {}, {'username': self.user}]
+        results = list(self.rocket.map(self.rocket.users_info, arg_sets, ordered=False))
+        self.assertEqual(sorted(result.index for result in results), [0, 1, 2])
+        failed = [result for result in results if result.exception is not None]
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].index, 1)
+        self.assertIsInstance(failed[0].exception, RocketMissingParamException)
+
+
+class TestAsyncFanOut(unittest.TestCase):
+    def run_with_client(self, scenario):
+        async def run():
+            rocket = rocketchat_async.RocketChat(server_url='http://127.0.0.1:1')
+            try:
+                return await scenario(rocket)
+            finally:
+                await rocket.close()
+
+        return asyncio.run(run())
+
+    def test_ordering(self):
+        async def echo(value):
+            await asyncio.sleep(0.05 * (5 - value))
+            return value
+
+        async def scenario(rocket):
+            ordered = [result.result async for result in rocket.amap(echo, range(5))]
+            completed = [result.result async for result in rocket.as_completed(echo, range(5))]
+            return ordered, completed
+
+        ordered, completed = self.run_with_client(scenario)
+        self.assertEqual(ordered, [0, 1, 2, 3, 4])
+        self.assertEqual(completed, [4, 3, 2, 1, 0])
+
+    def test_concurrency_bound_and_async_input(self):
+        running = {'now': 0, 'max': 0}
+
+        async def tracked(value):
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+            await asyncio.sleep(0.01)
+            running['now'] -= 1
+            return value * 2
+
+        async def arg_sets():
+            for value in range(20):
+                await asyncio.sleep(0)
+                yield (value,)
+
+        async def scenario(rocket):
+            return [result async for result in rocket.amap(tracked, arg_sets(), concurrency=3)]
+
+        results = self.run_with_client(scenario)
+        self.assertEqual([result.result for result in results], [value * 2 for value in range(20)])
+        self.assertEqual([result.arg_set for result in results], [(value,) for value in range(20)])
+        self.assertEqual(running['max'], 3)
+
+    def test_fail_fast_cancels_pending_calls(self):
+        cancelled = []
+
+        async def call(value):
+            if value == 1:
+                raise RocketMissingParamException('bad argument')
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(value)
+                raise
+
+        async def scenario(rocket):
+            captured = [result async for result in rocket.as_completed(call, [1])]
+            self.assertIsInstance(captured[0].exception, RocketMissingParamException)
+            with self.assertRaises(RocketMissingParamException):
+                async for _ in rocket.as_completed(call, range(4), fail_fast=True):
+                    pass
+            await asyncio.sleep(0)
+
+        self.run_with_client(scenario)
+        self.assertEqual(sorted(cancelled), [0, 2, 3])
+
+    def test_endpoint_limit_leaves_other_endpoints_free(self):
+        async def scenario():
+            stand_in = RestStandIn(delay=0.2)
+            rocket = rocketchat_async.RocketChat(server_url=await stand_in.start(), max_in_flight=4,
+                                                 endpoint_limits={'users.info': 1})
+            try:
+                queued = [asyncio.ensure_future(rocket.users_info(username='user1')) for _ in range(8)]
+                await asyncio.sleep(0.05)
+                started = time.monotonic()
+                await rocket.info()
+                elapsed = time.monotonic() - started
+                await asyncio.gather(*queued)
+            finally:
+                await rocket.close()
+                await stand_in.stop()
+            # One round-trip, not a wait for the users.info calls queued behind their limit
+            self.assertLess(elapsed, 0.5)
+
+        asyncio.run(scenario())
+
+
+class RestStandIn:
+    """Local stand-in of the REST API counting the requests per method.
+
+    routes maps a method (e.g. 'users.info') to a function, or coroutine function, of the request
+    returning the JSON body or an aiohttp response; other methods answer {'success': True}. Every
+    answer waits delay seconds first. Requests still being answered are dropped by stop()."""
+
+    def __init__(self, routes=None, delay=0):
+        self.routes = dict(routes or {})
+        self.delay = delay
+        self.hits = collections.Counter()
+        self.answering = set()
+        self.app = aiohttp.web.Application()
+        self.app.router.add_route('*', '/api/v1/{method:.+}', self.handle)
+        self.loop = None
+
+    async def start(self):
+        self.runner = aiohttp.web.AppRunner(self.app)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return 'http://127.0.0.1:{}'.format(self.runner.addresses[0][1])
+
+    async def stop(self):
+        for task in self.answering:
+            task.cancel()
+        await self.runner.cleanup()
+
+    def serve(self):
+        """Starts serving on a loop of its own thread, for the sync clients. Returns the server url."""
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    def shutdown(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.hits[method] += 1
+        task = asyncio.current_task()
+        self.answering.add(task)
+        try:
+            await asyncio.sleep(self.delay)
+            route = self.routes.get(method)
+            body = route(request) if route is not None else {'success': True}
+            if asyncio.iscoroutine(body):
+                body = await body
+        finally:
+            self.answering.discard(task)
+        if isinstance(body, aiohttp.web.StreamResponse):
+            return body
+        return aiohttp.web.json_response(body)
+
+
+class TestCoalescedReads(unittest.TestCase):
+    def test_sync_identical_reads_share_one_request(self):
+        stand_in = RestStandIn(delay=0.2)
+        rocket = RocketChat(server_url=stand_in.serve(), max_workers=8, coalesce_reads=True)
+        try:
+            results = list(rocket.map('users_info', [{'username': 'user1'}] * 8))
+            results += list(rocket.map('users_info', [{'username': 'user2'}] * 2))
+        finally:
+            rocket.close()
+            stand_in.shutdown()
+        for result in results:
+            self.assertTrue(result.result.json().get('success'))
+        self.assertEqual(stand_in.hits['users.info'], 2)
+        self.assertEqual(rocket._inflight_reads, {})
+
+    def test_async_identical_reads_share_one_request(self):
+        async def scenario():
+            stand_in = RestStandIn(delay=0.2)
+            rocket = rocketchat_async.RocketChat(server_url=await stand_in.start(), coalesce_reads=True)
+
+            async def raw_read():
+                with rocketchat_async.raw_responses():
+                    return await rocket.users_info(username='user1')
+
+            try:
+                raw, *results = await asyncio.gather(raw_read(),
+                                                     *[rocket.users_info(username='user1') for _ in range(8)])
+            finally:
+                await rocket.close()
+                await stand_in.stop()
+            self.assertTrue(all(result.get('success') for result in results))
+            self.assertEqual(raw.json(), {'success': True})
+            # Raw and decoded reads don't share a request
+            self.assertEqual(stand_in.hits['users.info'], 2)
+            self.assertEqual(rocket._inflight_reads, {})
+
+        asyncio.run(scenario())
+
+
+class TestNestedFanOut(unittest.TestCase):
+    def run_nested(self, stand_in, method, arg_sets):
+        """Runs method through map of a client with two pool threads, returns the results or None
+        if they don't come within 10 seconds."""
+        rocket = RocketChat(server_url=stand_in.serve(), max_workers=2)
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(rocket.map(method, arg_sets)), daemon=True)
+        try:
+            thread.start()
+            thread.join(10)
+        finally:
+            rocket.close(timeout=0)
+            stand_in.shutdown()
+        return results if not thread.is_alive() else None
+
+    def test_presence_snapshot_through_map(self):
+        stand_in = RestStandIn({
+            'users.presence': lambda request: aiohttp.web.json_response({'success': False}, status=404),
+            'users.getPresence': lambda request: {'presence': 'online', 'success': True},
+        })
+        results = self.run_nested(stand_in, 'users_presence_snapshot', [{'user_ids': ['u1', 'u2', 'u3']}] * 2)
+        self.assertIsNotNone(results, 'nested fan-out deadlocked')
+        for result in results:
+            self.assertIsNone(result.exception)
+            self.assertEqual(result.result.online(), {'u1', 'u2', 'u3'})
+        self.assertEqual(stand_in.hits['users.getPresence'], 6)
+
+    def test_settings_snapshot_through_map(self):
+        settings = [{'_id': 'Setting_{}'.format(number), 'value': number} for number in range(3)]
+
+        def settings_page(request):
+            offset, count = int(request.query['offset']), int(request.query['count'])
+            return {'success': True, 'settings': settings[offset:offset + count], 'total': len(settings)}
+
+        stand_in = RestStandIn({'settings': settings_page})
+        results = self.run_nested(stand_in, 'settings_snapshot', [{'page_size': 1}] * 2)
+        self.assertIsNotNone(results, 'nested fan-out deadlocked')
+        for result in results:
+            self.assertIsNone(result.exception)
+            self.assertEqual(result.result.values(), {'Setting_0': 0, 'Setting_1': 1, 'Setting_2': 2})
+
+
+class TestHedging(unittest.TestCase):
+    def hedged_reads(self, policy, calls, slow=()):
+        """Runs calls sequential rooms_info calls, the requests numbered in slow take a second."""
+        stand_in = RestStandIn()
+
+        async def rooms_info(request):
+            number = stand_in.hits['rooms.info']
+            if number in slow:
+                await asyncio.sleep(1)
+            return {'success': True, 'request': number}
+
+        stand_in.routes['rooms.info'] = rooms_info
+
+        async def scenario():
+            rocket = rocketchat_async.RocketChat(server_url=await stand_in.start(), hedge=policy)
+            try:
+                started = time.monotonic()
+                results = [await rocket.rooms_info(room_id='GENERAL') for _ in range(calls)]
+                elapsed = time.monotonic() - started
+                await asyncio.sleep(0.05)
+                return results, rocket.resources().get('in_flight'), elapsed
+            finally:
+                await rocket.close(timeout=0)
+                await stand_in.stop()
+
+        results, in_flight, elapsed = asyncio.run(scenario())
+        return results, in_flight, stand_in.hits['rooms.info'], elapsed
+
+    def test_slow_primary_is_hedged(self):
+        policy = HedgePolicy(delay=0.05, budget=1, max_tokens=1)
+        results, in_flight, requests_sent, elapsed = self.hedged_reads(policy, 1, slow=(1,))
+        self.assertEqual(results[0].get('request'), 2)
+        self.assertEqual(requests_sent, 2)
+        self.assertLess(elapsed, 0.5)
+        # The primary lost and was cancelled
+        self.assertEqual(in_flight, 0)
+        self.assertEqual(policy.metrics(), {'requests': 1, 'hedges': 1, 'hedge_wins': 1, 'hedge_rate': 1.0})
+
+    def test_budget_caps_hedges(self):
+        policy = HedgePolicy(delay=0, budget=0.5, max_tokens=1)
+        _, _, requests_sent, _ = self.hedged_reads(policy, 10)
+        self.assertEqual(policy.metrics().get('hedges'), 5)
+        self.assertEqual(requests_sent, 15)
+
+    def test_no_hedge_before_min_samples(self):
+        policy = HedgePolicy(percentile=50, budget=1, min_samples=3)
+        results, _, requests_sent, _ = self.hedged_reads(policy, 3, slow=(3,))
+        self.assertEqual(results[2].get('request'), 3)
+        self.assertEqual(requests_sent, 3)
+        self.assertEqual(policy.metrics().get('hedges'), 0)
+        self.assertIsNone(HedgePolicy(min_samples=3).hedge_delay('rooms.info'))
+
+        policy = HedgePolicy(percentile=50, budget=1, min_samples=3)
+        results, _, requests_sent, _ = self.hedged_reads(policy, 4, slow=(4,))
+        self.assertEqual(results[3].get('request'), 5)
+        self.assertEqual(policy.metrics().get('hedge_wins'), 1)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def test_grows_while_latency_is_flat(self):
+        limiter = AdaptiveLimiter(initial_limit=2, max_limit=4)
+        for _ in range(50):
+            limiter.acquire()
+            limiter.release(0.01, 200)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_backs_off_on_throttling_and_errors(self):
+        for status in (429, 503, None):
+            limiter = AdaptiveLimiter(initial_limit=10)
+            limiter.acquire()
+            limiter.release(0.01, status)
+            self.assertEqual(limiter.limit, 5)
+            self.assertEqual(limiter.metrics().get('in_flight'), 0)
+
+    def test_backs_off_on_rising_latency(self):
+        limiter = AdaptiveLimiter(initial_limit=10, tolerance=2.0)
+        limiter.acquire()
+        limiter.release(0.01, 200)
+        limiter.acquire()
+        limiter.release(0.5, 200)
+        self.assertLess(limiter.limit, 10)
+
+
+class TestPriorityScheduler(unittest.TestCase):
+    def grant_order(self, scheduler, names):
+        """Order in which callers queued in names, behind a held slot, get it."""
+        async def scenario():
+            granted = []
+
+            async def caller(name):
+                await scheduler.acquire(name)
+                granted.append(name)
+                scheduler.release()
+
+            await scheduler.acquire(INTERACTIVE)
+            tasks = []
+            for name in names:
+                tasks.append(asyncio.ensure_future(caller(name)))
+                await asyncio.sleep(0)
+            scheduler.release()
+            await asyncio.gather(*tasks)
+            return granted
+
+        return asyncio.run(scenario())
+
+    def test_highest_class_first(self):
+        scheduler = PriorityScheduler(slots=1, min_share={})
+        self.assertEqual(self.grant_order(scheduler, [BULK, DEFAULT, INTERACTIVE, BULK, INTERACTIVE]),
+                         [INTERACTIVE, INTERACTIVE, DEFAULT, BULK, BULK])
+        self.assertEqual(scheduler.metrics().get('in_use'), 0)
+        self.assertEqual(scheduler.metrics()['classes'][BULK]['granted'], 2)
+
+    def test_min_share_keeps_bulk_moving(self):
+        scheduler = PriorityScheduler(slots=1, min_share={BULK: 0.25}, decay=1)
+        self.assertEqual(self.grant_order(scheduler, [INTERACTIVE] * 6 + [BULK] * 3),
+                         [BULK, INTERACTIVE, INTERACTIVE, INTERACTIVE, BULK, INTERACTIVE, INTERACTIVE,
+                          INTERACTIVE, BULK])
+
+    def test_cancelled_waiters(self):
+        async def scenario():
+            scheduler = PriorityScheduler(slots=1)
+            await scheduler.acquire()
+            granted, gone, next_in_line = [asyncio.ensure_future(scheduler.acquire()) for _ in range(3)]
+            await asyncio.sleep(0)
+            gone.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.metrics()['classes'][DEFAULT]['waiting'], 2)
+            # The slot goes to granted, which is cancelled before it gets to use it
+            scheduler.release()
+            granted.cancel()
+            await next_in_line
+            self.assertTrue(granted.cancelled())
+            self.assertEqual(scheduler.metrics()['in_use'], 1)
+            self.assertEqual(scheduler.metrics()['classes'][DEFAULT]['waiting'], 0)
+            with self.assertRaises(ValueError):
+                await scheduler.acquire('urgent')
+
+        asyncio.run(scenario())
+
+
+class TestTimeouts(unittest.TestCase):
+    def test_as_requests(self):
+        self.assertEqual(timeouts.Timeout(connect=3, read=10).as_requests(), (3, 10))
+        self.assertEqual(timeouts.Timeout(connect=3, read=10, total=5).as_requests(), (3, 5))
+
+    def test_override(self):
+        default = timeouts.Timeout(connect=3, read=10)
+        with timeouts.override(read=1):
+            self.assertEqual(timeouts.effective_timeout(default).as_requests(), (None, 1))
+        self.assertIs(timeouts.effective_timeout(default), default)
+
+    def test_deadline_bounds_timeouts(self):
+        with timeouts.deadline(60):
+            with timeouts.deadline(5):
+                connect, read = timeouts.effective_timeout(timeouts.Timeout(connect=3, read=30)).as_requests()
+                self.assertEqual(connect, 3)
+                self.assertLessEqual(read, 5)
+        self.assertIsNone(timeouts.remaining())
+
+    def test_deadline_exceeded(self):
+        with timeouts.deadline(0):
+            with self.assertRaises(RocketDeadlineException):
+                timeouts.effective_timeout(timeouts.Timeout(read=30))
+
+    def test_deadline_fails_fast(self):
+        rocket = RocketChat()
+        with timeouts.deadline(0):
+            with self.assertRaises(RocketDeadlineException):
+                rocket.info()
+
+    def test_limiter_wait_counts_against_deadline(self):
+        stand_in = RestStandIn(delay=0.5)
+        limiter = AdaptiveLimiter(initial_limit=1, max_limit=1)
+        rocket = RocketChat(server_url=stand_in.serve(), limiter=limiter)
+        try:
+            holder = rocket.submit('info')
+            time.sleep(0.1)
+            started = time.monotonic()
+            with timeouts.deadline(0.2):
+                with self.assertRaises(RocketDeadlineException):
+                    rocket.info()
+            holder.result()
+        finally:
+            rocket.close()
+            stand_in.shutdown()
+        # Raised once the limiter let the call through, without a request or a cut of the limit
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(stand_in.hits['info'], 1)
+        self.assertEqual(limiter.metrics().get('in_flight'), 0)
+        self.assertEqual(limiter.metrics().get('decreases'), 0)
+
+
+class TestMessageSpool(unittest.TestCase):
+    def setUp(self):
+        self.rocket = RocketChat()
+        self.user = 'user1'
+        self.password = 'password'
+        self.email = 'email@domain.com'
+        self.rocket.users_register(
+            email=self.email, name=self.user, password=self.password, username=self.user)
+        self.rocket = RocketChat(self.user, self.password)
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_spool_drains_and_survives_restart(self):
+        spool = MessageSpool(self.rocket, self.path)
+        for i in range(5):
+            spool.post_message('spooled message {}'.format(i), channel='GENERAL')
+        spool.close()
+
+        spool = MessageSpool(self.rocket, self.path)
+        self.assertEqual(spool.backlog(), 5)
+        spool.start()
+        self.assertTrue(spool.flush(timeout=30))
+        self.assertEqual(spool.metrics().get('sent'), 5)
+        spool.close()
+
+    def test_spool_overflow(self):
+        spool = MessageSpool(self.rocket, self.path, max_size=2)
+        spool.post_message('first', channel='GENERAL')
+        spool.post_message('second', channel='GENERAL')
+        with self.assertRaises(RocketSpoolFullException):
+            spool.post_message('third', channel='GENERAL')
+        spool.overflow = DROP_OLDEST
+        spool.post_message('third', channel='GENERAL')
+        self.assertEqual(spool.backlog(), 2)
+        self.assertEqual(spool.metrics().get('dropped'), 1)
+        spool.close()
+
+
+class TestMessageSpoolDelivery(unittest.TestCase):
+    def setUp(self):
+        self.texts = []
+
+        async def post_message(request):
+            self.texts.append((await request.json()).get('text'))
+            return {'success': True}
+
+        self.stand_in = RestStandIn({'chat.postMessage': post_message})
+        self.rocket = RocketChat(server_url=self.stand_in.serve())
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    def tearDown(self):
+        self.rocket.close()
+        self.stand_in.shutdown()
+        os.remove(self.path)
+
+    def test_failed_message_does_not_block_its_room(self):
+        spool = MessageSpool(self.rocket, self.path)
+        spool.upload('GENERAL', 'tests/missing.png')
+        spool.post_message('after the upload', room_id='GENERAL')
+        spool.start()
+        self.assertTrue(spool.flush(timeout=10))
+        self.assertEqual(spool.metrics().get('failed'), 1)
+        self.assertEqual(self.texts, ['after the upload'])
+        spool.close()
+
+    def test_connection_errors_are_retried(self):
+        spool = MessageSpool(RocketChat(server_url='http://127.0.0.1:1'), self.path, retry_delay=0.01)
+        spool.post_message('kept', room_id='GENERAL')
+        spool.start()
+        self.assertFalse(spool.flush(timeout=0.3))
+        spool.close()
+        self.assertEqual(spool.failed, 0)
+        spool = MessageSpool(self.rocket, self.path)
+        spool.start()
+        self.assertTrue(spool.flush(timeout=10))
+        self.assertEqual(self.texts, ['kept'])
+        spool.close()
+
+    def test_drop_oldest_spares_message_in_flight(self):
+        self.stand_in.delay = 0.3
+        spool = MessageSpool(self.rocket, self.path, max_size=2, overflow=DROP_OLDEST)
+        spool.post_message('first', room_id='GENERAL')
+        spool.start()
+        while not spool.metrics().get('in_flight'):
+            time.sleep(0.01)
+        spool.post_message('second', room_id='GENERAL')
+        spool.post_message('third', room_id='GENERAL')
+        self.assertTrue(spool.flush(timeout=10))
+        self.assertEqual(self.texts, ['first', 'third'])
+        self.assertEqual(spool.metrics().get('sent'), 2)
+        self.assertEqual(spool.metrics().get('dropped'), 1)
+        spool.close()
+
+
+class TestMessageCoalescer(unittest.TestCase):
+    def posts(self, scenario, server_url=None, **kwargs):
+        """Runs scenario(coalescer) and returns what it returned and the posts the server received."""
+        posts = []
+
+        async def post_message(request):
+            posts.append(await request.json())
+            return {'success': True, 'message': {'msg': posts[-1].get('text')}}
+
+        async def run():
+            stand_in = RestStandIn({'chat.postMessage': post_message})
+            url = await stand_in.start()
+            rocket = rocketchat_async.RocketChat(server_url=server_url or url)
+            try:
+                return await scenario(MessageCoalescer(rocket, **kwargs))
+            finally:
+                await rocket.close()
+                await stand_in.stop()
+
+        return asyncio.run(run()), posts
+
+    def test_window_flush(self):
+        async def scenario(coalescer):
+            futures = [coalescer.post_message(text, room_id='GENERAL') for text in ('a', 'b', 'c')]
+            await asyncio.sleep(0.05)
+            self.assertEqual(coalescer.metrics().get('buffered'), 3)
+            return await asyncio.gather(*futures)
+
+        results, posts = self.posts(scenario, window=0.1)
+        self.assertEqual([post.get('text') for post in posts], ['a\nb\nc'])
+        self.assertEqual([result['message']['msg'] for result in results], ['a\nb\nc'] * 3)
+
+    def test_size_flush(self):
+        async def scenario(coalescer):
+            futures = [coalescer.post_message(text, room_id='GENERAL') for text in ('a', 'b', 'c')]
+            await asyncio.gather(*futures[:2])
+            self.assertEqual(coalescer.metrics(), {'messages': 3, 'posts': 1, 'buffered': 1})
+            await coalescer.flush()
+            return coalescer.metrics()
+
+        metrics, posts = self.posts(scenario, window=60, max_messages=2)
+        self.assertEqual([post.get('text') for post in posts], ['a\nb', 'c'])
+        self.assertEqual(metrics.get('posts'), 2)
+
+    def test_attachments_mode(self):
+        async def scenario(coalescer):
+            coalescer.post_message('a', room_id='GENERAL')
+            coalescer.post_message('b', room_id='GENERAL', attachments=[{'title': 'file'}])
+            await coalescer.flush()
+
+        _, posts = self.posts(scenario, mode=ATTACHMENTS)
+        self.assertEqual(posts[0].get('text'), '')
+        self.assertEqual(posts[0].get('attachments'), [{'text': 'a'}, {'text': 'b'}, {'title': 'file'}])
+
+    def test_buckets_per_room_and_options(self):
+        async def scenario(coalescer):
+            coalescer.post_message('a', room_id='GENERAL')
+            coalescer.post_message('b', room_id='GENERAL', alias='bot')
+            coalescer.post_message('c', room_id='other')
+            coalescer.post_message('d', room_id='GENERAL')
+            await coalescer.flush()
+
+        _, posts = self.posts(scenario)
+        self.assertEqual(sorted((post.get('roomId'), post.get('alias', ''), post.get('text')) for post in posts),
+                         [('GENERAL', '', 'a\nd'), ('GENERAL', 'bot', 'b'), ('other', '', 'c')])
+
+    def test_max_length(self):
+        async def scenario(coalescer):
+            for text in ('aaaa', 'bbbb', 'cccc', 'd' * 20):
+                coalescer.post_message(text, room_id='GENERAL')
+            await coalescer.flush()
+
+        _, posts = self.posts(scenario, max_length=10)
+        self.assertEqual([post.get('text') for post in posts], ['aaaa\nbbbb', 'cccc', 'd' * 20])
+
+    def test_errors_reach_every_message(self):
+        async def scenario(coalescer):
+            futures = [coalescer.post_message(text, room_id='GENERAL') for text in ('a', 'b')]
+            await coalescer.flush()
+            return await asyncio.gather(*futures, return_exceptions=True)
+
+        results, _ = self.posts(scenario, server_url='http://127.0.0.1:1')
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, aiohttp.ClientConnectionError)
+
+
+class TestSyncFacade(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = RestStandIn({'users.info': lambda request: {'success': True,
+                                                                    'user': {'username': request.query['username']}}})
+        self.url = self.stand_in.serve()
+
+    def tearDown(self):
+        self.stand_in.shutdown()
+
+    def test_calls_block_and_return_bodies(self):
+        with rocketchat_sync.RocketChat(server_url=self.url) as rocket:
+            self.assertEqual(rocket.users_info(username='user1')['user'], {'username': 'user1'})
+            self.assertEqual(rocket.submit('users_info', username='user2').result()['user'], {'username': 'user2'})
+            results = list(rocket.map('users_info', [{'username': name} for name in ('a', 'b', 'c')]))
+        self.assertEqual([result.result['user']['username'] for result in results], ['a', 'b', 'c'])
+        self.assertTrue(rocket.closed)
+
+    def test_generators_become_iterators(self):
+        with rocketchat_sync.RocketChat(server_url=self.url) as rocket:
+            outcomes = list(rocket.rooms_lifecycle('archive', [('room1', 'c'), ('room2', 'p')]))
+            results = rocket.as_completed('users_info', [{'username': name} for name in ('a', 'b')])
+            usernames = sorted(result.result['user']['username'] for result in results)
+        self.assertEqual(sorted((outcome.room_id, outcome.success) for outcome in outcomes),
+                         [('room1', True), ('room2', True)])
+        self.assertEqual(self.stand_in.hits['channels.archive'], 1)
+        self.assertEqual(self.stand_in.hits['groups.archive'], 1)
+        self.assertEqual(usernames, ['a', 'b'])
+
+    def test_leaving_an_iterator_early_closes_it(self):
+        self.stand_in.delay = 0.05
+        with rocketchat_sync.RocketChat(server_url=self.url) as rocket:
+            for _ in rocket.amap('users_info', [{'username': 'user1'}] * 100, concurrency=2):
+                break
+            self.assertEqual(rocket.resources().get('in_flight'), 0)
+        self.assertLess(self.stand_in.hits['users.info'], 10)
+
+
+class TestRawResponses(unittest.TestCase):
+    def setUp(self):
+        settings = [{'_id': 'Setting_{}'.format(number), 'value': number} for number in range(5)]
+
+        def settings_page(request):
+            offset, count = int(request.query['offset']), int(request.query['count'])
+            return {'success': True, 'settings': settings[offset:offset + count], 'total': len(settings)}
+
+        self.stand_in = RestStandIn({
+            'settings': settings_page,
+            'permissions.listAll': lambda request: {'success': True, 'update': [
+                {'_id': 'view-logs', 'roles': ['admin'], '_updatedAt': '2020-01-01T00:00:00.000Z'}], 'remove': []},
+            'rooms.info': lambda request: {'success': True, 'room': {'_id': request.query['roomId']}},
+            'channels.history': lambda request: {'success': True, 'messages': [{'_id': 'm1', 'ts': 'b'}]},
+        })
+
+    def run_raw(self, scenario):
+        async def run():
+            rocket = rocketchat_async.RocketChat(server_url=await self.stand_in.start(), raw=True)
+            try:
+                return await scenario(rocket)
+            finally:
+                await rocket.close()
+                await self.stand_in.stop()
+
+        return asyncio.run(run())
+
+    def test_raw_client(self):
+        async def scenario(rocket):
+            raw = await rocket.info()
+            with rocketchat_async.decoded_responses():
+                decoded = await rocket.info()
+                with rocketchat_async.raw_responses():
+                    nested = await rocket.info()
+            return raw, decoded, nested
+
+        raw, decoded, nested = self.run_raw(scenario)
+        self.assertIsInstance(raw, rocketchat_async.RawResponse)
+        self.assertEqual(raw.status, 200)
+        self.assertEqual(json.loads(bytes(raw.view())), {'success': True})
+        self.assertEqual(raw.json(), {'success': True})
+        self.assertEqual(decoded, {'success': True})
+        self.assertIsInstance(nested, rocketchat_async.RawResponse)
+
+    def test_helpers_decode_on_raw_clients(self):
+        async def scenario(rocket):
+            snapshot = await rocket.settings_snapshot(page_size=2)
+            index = await rocket.permissions_index()
+            outcomes = [outcome async for outcome in rocket.rooms_lifecycle('archive', [('GENERAL', 'c')])]
+            messages = await rocket.rooms_history_since('GENERAL', 'c', 'a', count=10)
+            room = await RealtimeCache(rocket).room('GENERAL')
+            # Still raw outside of the helpers
+            return snapshot, index, outcomes, messages, room, await rocket.info()
+
+        snapshot, index, outcomes, messages, room, info = self.run_raw(scenario)
+        self.assertEqual(len(snapshot.values()), 5)
+        self.assertTrue(index.can('admin', 'view-logs'))
+        self.assertTrue(outcomes[0].success)
+        self.assertEqual(messages, [{'_id': 'm1', 'ts': 'b'}])
+        self.assertEqual(room, {'_id': 'GENERAL'})
+        self.assertIsInstance(info, rocketchat_async.RawResponse)
+
+
+class TestQuery(unittest.TestCase):
+    def test_params(self):
+        query = Query().only('_id', 'name').exclude('customFields').where(t='c').order_by('-ts', 'name')
+        self.assertEqual(query.params(), {
+            'fields': '{"_id":1,"name":1,"customFields":0}',
+            'query': '{"t":"c"}',
+            'sort': '{"ts":-1,"name":1}',
+        })
+
+    def test_empty_parts_are_left_out(self):
+        self.assertEqual(Query().params(), {})
+        self.assertEqual(set(Query().order_by('name').params()), {'sort'})
+
+    def test_presets_are_not_modified(self):
+        LEAN_USER.where(active=True).only('name')
+        self.assertEqual(LEAN_USER.params(), {'fields': '{"_id":1,"username":1}'})
+
+    def test_get_values_are_sent_as_given(self):
+        stand_in = RestStandIn({'users.info': lambda request: {'success': True, 'username': request.query['username']}})
+        value = '50%25 & a+b'
+
+        async def async_read():
+            rocket = rocketchat_async.RocketChat(server_url=url)
+            try:
+                return (await rocket.users_info(username=value)).get('username')
+            finally:
+                await rocket.close()
+
+        url = stand_in.serve()
+        try:
+            with RocketChat(server_url=url) as rocket:
+                self.assertEqual(rocket.users_info(username=value).json().get('username'), value)
+            self.assertEqual(asyncio.run(async_read()), value)
+        finally:
+            stand_in.shutdown()
+
+
+class TestPresenceTable(unittest.TestCase):
+    def test_full_and_delta_updates(self):
+        table = PresenceTable()
+        table.apply({'full': True, 'users': [{'_id': 'a', 'username': 'alice', 'status': 'online'},
+                                             {'_id': 'b', 'username': 'bob', 'status': 'away'}]}, 'cursor1')
+        self.assertEqual(table.status(username='alice'), 'online')
+        self.assertEqual(table.online(), {'a', 'b'})
+        table.apply({'full': False, 'users': [{'_id': 'a', 'status': 'busy'}]}, 'cursor2')
+        self.assertEqual(table.status('a'), 'busy')
+        self.assertEqual(table.status('b'), 'away')
+        self.assertEqual(table.cursor, 'cursor2')
+        table.apply({'full': True, 'users': [{'_id': 'a', 'status': 'online'}]}, 'cursor3')
+        self.assertEqual(table.status('b'), 'offline')
+        self.assertEqual(table.status('unknown'), 'offline')
+
+    def test_only_tracks_given_users(self):
+        table = PresenceTable(user_ids=['a'])
+        table.apply({'full': True, 'users': [{'_id': 'a', 'status': 'online'}, {'_id': 'b', 'status': 'online'}]},
+                    'cursor')
+        self.assertEqual(table.online(), {'a'})
+        self.assertEqual(len(table), 1)
+
+
+class TestRoomSweep(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        os.remove(self.path)
+        self.oldest = datetime.datetime(2020, 1, 1)
+        self.latest = datetime.datetime(2020, 1, 10)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_chunks_adapt_to_latency(self):
+        sweep = RoomSweep('GENERAL', self.oldest, self.latest, target_latency=1.0)
+        self.assertEqual(sweep.next_chunk(), ('2020-01-01T00:00:00.000Z', '2020-01-02T00:00:00.000Z'))
+        sweep.done(0.1, 5)
+        self.assertEqual(sweep.next_chunk(), ('2020-01-02T00:00:00.000Z', '2020-01-04T00:00:00.000Z'))
+        sweep.done(2.0, 5)
+        self.assertEqual(sweep.next_chunk(), ('2020-01-04T00:00:00.000Z', '2020-01-05T00:00:00.000Z'))
+        sweep.timed_out(Exception())
+        self.assertEqual(sweep.next_chunk(), ('2020-01-04T00:00:00.000Z', '2020-01-04T12:00:00.000Z'))
+        self.assertEqual(sweep.removed, 10)
+        self.assertFalse(sweep.finished)
+
+    def test_gives_up_at_minimum_chunk(self):
+        sweep = RoomSweep('GENERAL', self.oldest, self.latest, initial_chunk=datetime.timedelta(minutes=1))
+        with self.assertRaises(ValueError):
+            sweep.timed_out(ValueError())
+
+    def test_resumes_from_checkpoint(self):
+        sweep = RoomSweep('GENERAL', self.oldest, self.latest, RetentionCheckpoint(self.path))
+        sweep.next_chunk()
+        sweep.done(0.1, 7)
+        resumed = RoomSweep('GENERAL', self.oldest, self.latest, RetentionCheckpoint(self.path))
+        self.assertEqual(resumed.cursor, datetime.datetime(2020, 1, 2))
+        self.assertEqual(resumed.removed, 7)
+        other_range = RoomSweep('GENERAL', self.oldest, datetime.datetime(2020, 2, 1), RetentionCheckpoint(self.path))
+        self.assertEqual(other_range.cursor, self.oldest)
+
+
+class TestLifecycle(unittest.TestCase):
+    def test_last_activity(self):
+        room = {'_id': 'GENERAL', 't': 'c', 'ts': '2020-01-01T00:00:00.000Z', 'lm': '2020-02-01T10:00:00.500Z'}
+        self.assertEqual(last_activity(room),
+                         datetime.datetime(2020, 2, 1, 10, 0, 0, 500000, tzinfo=datetime.timezone.utc))
+        self.assertEqual(last_activity({'_updatedAt': {'$date': 0}}),
+                         datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertIsNone(last_activity({}))
+
+    def test_is_stale(self):
+        cutoff = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+        self.assertTrue(is_stale({'t': 'p', 'lm': '2020-01-01T00:00:00.000Z'}, cutoff))
+        self.assertFalse(is_stale({'t': 'c', 'lm': '2020-07-01T00:00:00.000Z'}, cutoff))
+        self.assertFalse(is_stale({'t': 'd', 'lm': '2020-01-01T00:00:00.000Z'}, cutoff))
+
+    def test_method_for(self):
+        self.assertEqual(room_key({'_id': 'GENERAL', 't': 'c'}), ('GENERAL', 'c'))
+        self.assertEqual(method_for('set_type', 'p'), 'groups_set_type')
+        with self.assertRaises(ValueError):
+            method_for('archive', 'd')
+
+
+class TestStatistics(unittest.TestCase):
+    def test_flatten(self):
+        stats = {'totalUsers': 3, 'version': '3.0.0', 'migration': {'locked': False, 'version': 170},
+                 'uploadsTotalSize': 1.5, 'apps': [{'name': 'x'}]}
+        self.assertEqual(flatten(stats), {'totalUsers': 3, 'migration.version': 170, 'uploadsTotalSize': 1.5})
+
+
+class TestSettingsSnapshot(unittest.TestCase):
+    def test_diff(self):
+        snapshot = SettingsSnapshot([{'_id': 'Site_Name', 'value': 'Rocket.Chat'},
+                                     {'_id': 'API_Allow_Infinite_Count', 'value': True}])
+        self.assertEqual(snapshot.diff({'Site_Name': 'Rocket.Chat', 'API_Allow_Infinite_Count': False,
+                                        'Unknown': 1}), {'API_Allow_Infinite_Count': False, 'Unknown': 1})
+        snapshot.set('API_Allow_Infinite_Count', False)
+        self.assertEqual(snapshot.values(), {'Site_Name': 'Rocket.Chat', 'API_Allow_Infinite_Count': False})
+        self.assertIsNone(snapshot.get('Unknown'))
+
+    def snapshot_and_stand_in(self):
+        snapshot = SettingsSnapshot([{'_id': 'Setting_{}'.format(number), 'value': 0} for number in range(4)])
+        routes = {'settings/Setting_{}'.format(number): lambda request: {'success': True} for number in range(3)}
+        routes['settings/Setting_3'] = lambda request: aiohttp.web.json_response({'success': False}, status=400)
+        return snapshot, RestStandIn(routes)
+
+    def test_apply(self):
+        snapshot, stand_in = self.snapshot_and_stand_in()
+        rocket = RocketChat(server_url=stand_in.serve())
+        desired = {'Setting_0': 0, 'Setting_1': 1, 'Setting_2': 2, 'Setting_3': 3}
+        try:
+            started = time.monotonic()
+            results = rocket.settings_apply(desired, snapshot, rate=10)
+            elapsed = time.monotonic() - started
+        finally:
+            rocket.close()
+            stand_in.shutdown()
+        self.assertIsInstance(results, list)
+        self.assertEqual(sorted(result.arg_set[0] for result in results), ['Setting_1', 'Setting_2', 'Setting_3'])
+        self.assertEqual(snapshot.values(), {'Setting_0': 0, 'Setting_1': 1, 'Setting_2': 2, 'Setting_3': 0})
+        # Three updates at ten a second start over at least 0.2 seconds
+        self.assertGreaterEqual(elapsed, 0.2)
+
+    def test_async_apply(self):
+        async def scenario():
+            snapshot, stand_in = self.snapshot_and_stand_in()
+            rocket = rocketchat_async.RocketChat(server_url=await stand_in.start())
+            try:
+                # Not iterated on purpose: the updates are made when awaited
+                await rocket.settings_apply({'Setting_1': 1, 'Setting_3': 3}, snapshot, rate=100)
+            finally:
+                await rocket.close()
+                await stand_in.stop()
+            self.assertEqual(stand_in.hits['settings/Setting_1'], 1)
+            self.assertEqual(snapshot.values(), {'Setting_0': 0, 'Setting_1': 1, 'Setting_2': 0, 'Setting_3': 0})
+
+        asyncio.run(scenario())
+
+
+class TestPermissionIndex(unittest.TestCase):
+    def test_apply(self):
+        index = PermissionIndex()
+        index.apply({'update': [{'_id': 'view-logs', 'roles': ['admin'], '_updatedAt': '2020-01-01T00:00:00.000Z'},
+                                {'_id': 'delete-message', 'roles': ['admin', 'owner'],
+                                 '_updatedAt': '2020-01-02T00:00:00.000Z'}], 'remove': []})
+        self.assertTrue(index.can('owner', 'delete-message'))
+        self.assertFalse(index.can('owner', 'view-logs'))
+        self.assertEqual(index.permissions('admin'), {'view-logs', 'delete-message'})
+        self.assertEqual(index.cursor, '2020-01-02T00:00:00.000Z')
+        index.apply({
+            'update': [{'_id': 'delete-message', 'roles': ['admin'], '_updatedAt': '2020-01-03T00:00:00.000Z'}],
+            'remove': [{'_id': 'view-logs', '_updatedAt': '2020-01-04T00:00:00.000Z'}],
+        })
+        self.assertFalse(index.can('owner', 'delete-message'))
+        self.assertNotIn('view-logs', index)
+        self.assertEqual(index.permissions('owner'), frozenset())
+        self.assertEqual(index.cursor, '2020-01-04T00:00:00.000Z')
+
+
+class TestClientLifecycle(unittest.TestCase):
+    def setUp(self):
+        # Nothing listens there, requests fail right away
+        self.rocket = RocketChat(server_url='http://127.0.0.1:1')
+
+    def test_failed_upload_closes_file(self):
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.rocket.rooms_upload('GENERAL', file='tests/avatar.png')
+        self.assertEqual(self.rocket.resources().get('open_files'), 0)
+
+    def test_closed_client_rejects_calls(self):
+        with self.rocket as rocket:
+            self.assertFalse(rocket.resources().get('closed'))
+        self.assertEqual(self.rocket.resources().get('in_flight'), 0)
+        self.assertTrue(self.rocket.resources().get('closed'))
+        with self.assertRaises(RocketClientClosedException):
+            self.rocket.info()
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = RestStandIn({
+            'me': lambda request: {'success': True, 'username': 'user1'},
+            'permissions.listAll': lambda request: {'success': True, 'update': [
+                {'_id': 'view-logs', 'roles': ['admin'], '_updatedAt': '2020-01-01T00:00:00.000Z'}], 'remove': []},
+        })
+
+    def test_keeps_bootstrap_results(self):
+        rocket = RocketChat(server_url=self.stand_in.serve(), max_workers=2)
+        try:
+            report = rocket.warmup(connections=4, bootstrap=('me', 'permissions_index'))
+        finally:
+            rocket.close()
+            self.stand_in.shutdown()
+        self.assertEqual(report.get('errors'), {})
+        self.assertEqual(report.get('connections'), 2)
+        self.assertEqual(rocket.bootstrapped.get('me').json().get('username'), 'user1')
+        self.assertTrue(rocket.permissions.can('admin', 'view-logs'))
+        self.assertIs(rocket.permissions, report.get('results').get('permissions_index'))
+
+    def test_async_keeps_bootstrap_results(self):
+        async def scenario():
+            rocket = rocketchat_async.RocketChat(server_url=await self.stand_in.start())
+            try:
+                await rocket.warmup(connections=3, bootstrap=('me', 'permissions_index'))
+            finally:
+                await rocket.close()
+                await self.stand_in.stop()
+            self.assertEqual(rocket.bootstrapped.get('me').get('username'), 'user1')
+            self.assertTrue(rocket.permissions.can('admin', 'view-logs'))
+            self.assertEqual(self.stand_in.hits['info'], 1)
+
+        asyncio.run(scenario())
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_scenario(self):
+        with self.assertRaises(ValueError):
+            Scenario(weights={'upload': 1})
+        with self.assertRaises(ValueError):
+            Scenario(weights={'delete': 1})
+        scenario = Scenario(weights={'post': 1}, message_size=10)
+        rng = random.Random(1)
+        self.assertEqual(scenario.next_action(rng), 'post')
+        self.assertEqual(len(scenario.message(rng)), 10)
+
+    def test_report(self):
+        report = LoadReport()
+        for latency in range(1, 101):
+            report.record('post', latency / 1000.0, latency % 10 != 0)
+        summary = report.summary().get('post')
+        self.assertEqual(summary.get('count'), 100)
+        self.assertEqual(summary.get('errors'), 10)
+        self.assertEqual(summary.get('p50'), 0.051)
+        self.assertEqual(summary.get('p99'), 0.1)
+        self.assertIn('post', report.format())
+
+    def test_run_against_stand_in(self):
+        async def login(request):
+            form = await request.post()
+            if form['password'] != 'pass':
+                return aiohttp.web.json_response({'status': 'error'}, status=401)
+            return {'status': 'success', 'data': {'authToken': 'token', 'userId': form['username']}}
+
+        async def scenario():
+            stand_in = RestStandIn({
+                'login': login,
+                'users.register': lambda request: {'success': True},
+                'channels.join': lambda request: {'success': True},
+                'chat.postMessage': lambda request: {'success': True},
+                'channels.history': lambda request: {'success': False},
+            })
+            url = await stand_in.start()
+            try:
+                users = await register_users(url, 2, password='pass')
+                generator = LoadGenerator(url, users + [('intruder', 'wrong')],
+                                          Scenario(rooms=('GENERAL', 'random'), think_time=0.01),
+                                          duration=0.5, seed=1)
+                report = await generator.run()
+            finally:
+                await stand_in.stop()
+            return users, report.summary(), stand_in.hits
+
+        users, summary, hits = asyncio.run(scenario())
+        self.assertEqual(users, [('loadtest-0', 'pass'), ('loadtest-1', 'pass')])
+        self.assertEqual(hits['users.register'], 2)
+        self.assertEqual((summary['login']['count'], summary['login']['errors']), (3, 1))
+        self.assertEqual((summary['join']['count'], summary['join']['errors']), (4, 0))
+        self.assertEqual(summary['post']['count'], hits['chat.postMessage'])
+        self.assertEqual(summary['post']['errors'], 0)
+        self.assertEqual(summary['history']['count'], hits['channels.history'])
+        self.assertEqual(summary['history']['errors'], summary['history']['count'])
+        for action in ('post', 'history'):
+            stats = summary[action]
+            self.assertGreater(stats['count'], 10)
+            self.assertGreater(stats['throughput'], 0)
+            self.assertTrue(0 < stats['p50'] <= stats['p90'] <= stats['p95'] <= stats['p99'] <= stats['max'])
+
+
+class TestRequestLog(unittest.TestCase):
+    def setUp(self):
+        self.rocket = RocketChat(server_url='http://127.0.0.1:1')
+
+    def tearDown(self):
+        request_log.set_sample_rate(1.0)
+
+    def test_failed_request_is_logged(self):
+        with self.assertLogs('rocketchat_API.requests', level='DEBUG') as logs:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.rocket.info()
+        self.assertEqual(logs.records[0].endpoint, 'info')
+        self.assertIsNone(logs.records[0].status)
+        self.assertIn('GET info ConnectionError', logs.output[0])
+
+    def test_sample_rate(self):
+        with self.assertRaises(ValueError):
+            request_log.set_sample_rate(2)
+        request_log.set_sample_rate(0.0)
+        with self.assertLogs('rocketchat_API.requests', level='DEBUG') as logs:
+            request_log.logger.debug('marker')
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.rocket.info()
+        self.assertEqual(len(logs.records), 1)
+
+
+class TestBatch(unittest.TestCase):
+    def test_refs(self):
+        created = BatchFuture()
+        created.method = 'channels_create'
+        args = ('GENERAL', [created['channel']['_id']], {'topic': created})
+        self.assertEqual(dependencies(args), {created})
+        created.set_result({'channel': {'_id': 'abc'}})
+        self.assertEqual(resolve(args), ('GENERAL', ['abc'], {'topic': {'channel': {'_id': 'abc'}}}))
+        with self.assertRaises(RocketMissingParamException):
+            created['group']['_id'].resolve()
+
+    def batch_stand_in(self):
+        topics = {}
+
+        async def create(request):
+            name = (await request.json())['name']
+            return {'success': True, 'channel': {'_id': name + '-id'}} if name != 'broken' else {'success': False}
+
+        async def set_topic(request):
+            body = await request.json()
+            topics[body['roomId']] = body['topic']
+            return {'success': True, 'topic': body['topic']}
+
+        return RestStandIn({'channels.create': create, 'channels.setTopic': set_topic}), topics
+
+    def test_async_batch(self):
+        async def scenario():
+            stand_in, topics = self.batch_stand_in()
+            rocket = rocketchat_async.RocketChat(server_url=await stand_in.start())
+            try:
+                async with rocket.batch() as batch:
+                    created = batch.channels_create('room')
+                    topic = batch.channels_set_topic(created['channel']['_id'], 'hello')
+                    broken = batch.channels_create('broken')
+                    orphan = batch.channels_set_topic(broken['channel']['_id'], 'lost')
+                    follower = batch.channels_set_topic(orphan['topic'], 'lost too')
+            finally:
+                await rocket.close()
+                await stand_in.stop()
+            self.assertIsInstance(created, AsyncBatchFuture)
+            self.assertEqual(topic.result(), {'success': True, 'topic': 'hello'})
+            self.assertEqual(topics, {'room-id': 'hello'})
+            self.assertEqual(broken.result(), {'success': False})
+            self.assertIsInstance(orphan.exception(), RocketMissingParamException)
+            self.assertIs(follower.exception(), orphan.exception())
+            self.assertEqual(stand_in.hits['channels.setTopic'], 1)
+
+        asyncio.run(scenario())
+
+    def test_sync_facade_batch(self):
+        stand_in, topics = self.batch_stand_in()
+        try:
+            with rocketchat_sync.RocketChat(server_url=stand_in.serve()) as rocket:
+                with rocket.batch() as batch:
+                    created = batch.channels_create('room')
+                    topic = batch.channels_set_topic(created['channel']['_id'], 'hello')
+        finally:
+            stand_in.shutdown()
+        self.assertIsInstance(created, BatchFuture)
+        self.assertEqual(topic.result(), {'success': True, 'topic': 'hello'})
+        self.assertEqual(topics, {'room-id': 'hello'})
+
+
+class NotifyStandIn:
+    """Local stand-in of the realtime API (DDP over websocket) and of rooms.info for NotifyFeed tests."""
+
+    def __init__(self):
+        self.room_fetches = 0
+        self.sockets = []
+        self.app = aiohttp.web.Application()
+        self.app.router.add_get('/websocket', self.websocket)
+        self.app.router.add_get('/api/v1/rooms.info', self.rooms_info)
+
+    async def start(self):
+        self.runner = aiohttp.web.AppRunner(self.app)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return 'http://127.0.0.1:{}'.format(self.runner.addresses[0][1])
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def rooms_info(self, request):
+        self.room_fetches += 1
+        return aiohttp.web.json_response({'success': True, 'room': {'_id': request.query['roomId'], 'topic': 'old'}})
+
+    async def websocket(self, request):
+        ws = aiohttp.web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        async for message in ws:
+            payload = json.loads(message.data)
+            if payload['msg'] == 'connect':
+                await ws.send_json({'msg': 'connected', 'session': 'stand-in'})
+            elif payload['msg'] == 'method':
+                await ws.send_json({'msg': 'result', 'id': payload['id'], 'result': {'id': 'user'}})
+            elif payload['msg'] == 'sub':
+                await ws.send_json({'msg': 'ready', 'subs': [payload['id']]})
+        return ws
+
+    async def emit(self, collection, event, args):
+        for ws in self.sockets:
+            await ws.send_json({'msg': 'changed', 'collection': collection, 'id': 'id',
+                                'fields': {'eventName': event, 'args': args}})
+
+
+class TestNotifyFeed(unittest.TestCase):
+    def test_events_patch_and_evict_cached_rooms(self):
+        async def scenario():
+            stand_in = NotifyStandIn()
+            url = await stand_in.start()
+            rocket = rocketchat_async.RocketChat(auth_token='token', user_id='user', server_url=url)
+            cache = RealtimeCache(rocket)
+            try:
+                async with NotifyFeed(rocket, cache) as feed:
+                    self.assertTrue(await feed.wait_connected(timeout=5))
+                    self.assertEqual((await cache.room('GENERAL')).get('topic'), 'old')
+                    await cache.room('GENERAL')
+                    self.assertEqual(stand_in.room_fetches, 1)
+
+                    await stand_in.emit('stream-notify-user', 'user/rooms-changed',
+                                        ['updated', {'_id': 'GENERAL', 'topic': 'new'}])
+                    while cache.metrics().get('patches') < 1:
+                        await asyncio.sleep(0.01)
+                    self.assertEqual((await cache.room('GENERAL')).get('topic'), 'new')
+                    self.assertEqual(stand_in.room_fetches, 1)
+
+                    await stand_in.emit('stream-notify-user', 'user/rooms-changed', ['removed', {'_id': 'GENERAL'}])
+                    while cache.metrics().get('evictions') < 1:
+                        await asyncio.sleep(0.01)
+                    await cache.room('GENERAL')
+                    self.assertEqual(stand_in.room_fetches, 2)
+            finally:
+                await rocket.close()
+                await stand_in.stop()
+
+        asyncio.run(scenario())
+
+
+class TestRealtimeCache(unittest.TestCase):
+    def test_apply(self):
+        cache = RealtimeCache(None)
+        cache._entries['users']['u1'] = {'_id': 'u1', 'username': 'alice', 'status': 'online'}
+        cache._usernames['alice'] = 'u1'
+        cache.apply('user-status', [['u1', 'alice', 2, '']])
+        cache.apply('updateAvatar', [{'username': 'alice', 'etag': 'e1'}])
+        cache.apply('user-status', [['u2', 'bob', 1, '']])
+        self.assertEqual(cache._entries['users']['u1'], {'_id': 'u1', 'username': 'alice', 'status': 'away',
+                                                         'avatarETag': 'e1'})
+        cache.apply('roles-change', [{'type': 'added', '_id': 'admin', 'u': {'_id': 'u1'}}])
+        self.assertEqual(cache.metrics().get('users'), 0)
+        self.assertEqual(cache.metrics().get('events'), 4)
+
+
+class TestRoomWatcher(unittest.TestCase):
+    def setUp(self):
+        self.watcher = RoomWatcher(min_interval=1, max_interval=8, jitter=0)
+        self.watcher.add('r1', 'c')
+        self.watcher.add('r2', 'p')
+        self.watcher.add('r3', 'l')
+
+    def test_intervals_adapt_to_activity(self):
+        self.assertEqual(sorted(self.watcher.select(0)), ['r1', 'r2'])
+        self.watcher.polled('r1', [{'ts': '2030-01-01T00:00:00.000Z'}], 0)
+        for now in range(0, 40, 8):
+            self.watcher.polled('r2', [], now)
+        self.assertEqual(self.watcher.cursor('r1'), '2030-01-01T00:00:00.000Z')
+        self.assertEqual(self.watcher.select(1), ['r1'])
+        self.assertEqual(self.watcher.rooms['r2']['interval'], 8)
+        self.assertEqual(self.watcher.metrics()['hot'], 1)
+
+    def test_subscriptions_select_changed_rooms(self):
+        self.assertEqual(self.watcher.apply_subscriptions({'update': [{'rid': 'r1', '_updatedAt': 'a'}]}), set())
+        changed = self.watcher.apply_subscriptions({'update': [{'rid': 'r2', '_updatedAt': 'b'},
+                                                               {'rid': 'r4', 't': 'd', '_updatedAt': 'c'}]},
+                                                   watch_new=True)
+        self.assertEqual(changed, {'r2', 'r4'})
+        self.assertEqual(self.watcher.subscriptions_cursor, 'c')
+        self.watcher.failed('r1', 0)
+        self.assertEqual(sorted(self.watcher.select(1, changed)), ['r1', 'r2', 'r4'])
+        self.watcher.polled('r1', [], 1)
+        self.assertEqual(self.watcher.select(2, set()), [])
+        self.assertEqual(sorted(self.watcher.select(8, set())), ['r2', 'r4'])
+        self.watcher.apply_subscriptions({'remove': [{'rid': 'r4'}]}, watch_new=True)
+        self.assertNotIn('r4', self.watcher.rooms)
+
+    def test_safety_polls_are_spread(self):
+        watcher = RoomWatcher(min_interval=2, max_interval=300)
+        for number in range(10000):
+            watcher.add('r{}'.format(number), 'c', now=0)
+        watcher.apply_subscriptions({'update': []})
+        self.assertLess(len(watcher.select(0)), 10000)
+        due = [len(watcher.select(now, set())) for now in range(150, 301, 30)]
+        # First safety polls fall between 150s and 300s, a growing share of the rooms over time
+        self.assertEqual(due, sorted(due))
+        self.assertLess(due[1], 10000 / 2)
+        self.assertEqual(due[-1], 10000)
+        for room_id in watcher.select(300, set()):
+            watcher.polled(room_id, [], 300)
+        self.assertEqual(watcher.select(449, set()), [])
+        self.assertLess(len(watcher.select(500, set())), 10000)
+
+
 if __name__ == '__main__':
     unittest.main(warnings='ignore')